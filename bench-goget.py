@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Benchmark the Go modules downloader against a synthetic local GOPROXY (no network access needed)
+
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+import goget
+
+PREFIX = "example.com/bench"
+VERSION = "v1.0.0"
+INFO = json.dumps({"Version": VERSION, "Time": "2024-01-01T00:00:00Z"})
+
+
+def hash1(files):
+    """The h1: hash of go.sum, from a list of (name, content)."""
+    summary = "".join(f"{hashlib.sha256(data).hexdigest()}  {name}\n" for name, data in sorted(files))
+    return "h1:" + base64.b64encode(hashlib.sha256(summary.encode()).digest()).decode()
+
+
+def module_path(i):
+    return f"{PREFIX}/m{i:05d}"
+
+
+def go_mod(path, requires):
+    """go.mod without graph pruning, so that the requirements of a module are only its direct dependencies."""
+    lines = [f"module {path}\n", "\ngo 1.16\n"]
+    if requires:
+        lines.append("\nrequire (\n")
+        lines.extend(f"\t{r} {VERSION}\n" for r in requires)
+        lines.append(")\n")
+    return "".join(lines).encode()
+
+
+def go_source(package, imports):
+    """A package that references the packages of its dependencies."""
+    lines = [f"package {package}\n\n"]
+    if imports:
+        lines.append("import (\n")
+        lines.extend(f'\td{k} "{p}"\n' for k, p in enumerate(imports))
+        lines.append(")\n\n")
+    lines.append("var deps = []func() int{" + ", ".join(f"d{k}.F" for k in range(len(imports))) + "}\n\n")
+    lines.append("func F() int { return len(deps) }\n")
+    return "".join(lines).encode()
+
+
+def write_module(proxy, path, files, gomod):
+    """Write the list, info, mod and zip files of a module version into a GOPROXY tree.
+    Return the go.sum lines of the module."""
+    d = proxy / goget.escape_path(path) / "@v"
+    d.mkdir(parents=True, exist_ok=True)
+    d.joinpath("list").write_text(f"{VERSION}\n")
+    d.joinpath(f"{VERSION}.info").write_text(INFO)
+    d.joinpath(f"{VERSION}.mod").write_bytes(gomod)
+    files = [(f"{path}@{VERSION}/{name}", data) for name, data in files]
+    with zipfile.ZipFile(d / f"{VERSION}.zip", "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in files:
+            z.writestr(name, data)
+    return [f"{path} {VERSION} {hash1(files)}", f"{path} {VERSION}/go.mod {hash1([('go.mod', gomod)])}"]
+
+
+def make_proxy(proxy, count, zip_size, fanout, bins):
+    """Generate a GOPROXY tree of `count` modules. Module i depends on the `fanout` next ones.
+    Each zip has about `zip_size` bytes of incompressible data (and as much of zeros).
+    A command module has `bins` main packages, each importing a module (and its dependencies)."""
+
+    rnd = random.Random(count * 1000 + fanout)
+    deps = [list(range(i + 1, min(i + 1 + fanout, count))) for i in range(count)]
+    gosums = []
+    for i in range(count):
+        path = module_path(i)
+        imports = [module_path(j) for j in deps[i]]
+        gomod = go_mod(path, imports)
+        files = [
+            ("go.mod", gomod),
+            ("m.go", go_source(f"m{i:05d}", imports)),
+            ("data.bin", rnd.randbytes(zip_size) + bytes(zip_size)),
+        ]
+        gosums.append(write_module(proxy, path, files, gomod))
+
+    # the command module requires all the modules reachable from its packages
+    reachable, todo = set(), [j % count for j in range(bins)]
+    while todo:
+        i = todo.pop()
+        if i not in reachable:
+            reachable.add(i)
+            todo.extend(deps[i])
+    path = f"{PREFIX}/cmd"
+    gomod = go_mod(path, [module_path(i) for i in sorted(reachable)])
+    files = [("go.mod", gomod)]
+    files.append(("go.sum", "".join(f"{line}\n" for i in sorted(reachable) for line in gosums[i]).encode()))
+    for j in range(bins):
+        files.append((f"c{j:03d}/main.go", go_source("main", [module_path(j % count)]) + b"\nfunc main() {}\n"))
+    write_module(proxy, path, files, gomod)
+
+
+def clean():
+    """Empty GOPATH and the work directories of goget.py."""
+    for d in [*Path("/go").iterdir(), Path("/tmp/gopath"), Path("/project")]:
+        if d.is_dir():
+            goget.remove_tree(d)
+        elif d.exists():
+            d.unlink()
+
+
+def run_scenario(scenario, proxy, output):
+    """Run the stages of goget.py for a scenario, in this process. Return the measures."""
+
+    os.environ.update(GOPROXY=f"file://{proxy}", GOSUMDB="off", GOTOOLCHAIN="local", GOFLAGS="")
+    os.environ.pop("GOPRIVATE", None)
+    os.environ.pop("GONOPROXY", None)
+    clean()
+    output.mkdir(parents=True, exist_ok=True)
+
+    mods = [f"{module_path(i)}@{VERSION}" for i in range(scenario["modules"])]
+    bins = [f"{PREFIX}/cmd/c{j:03d}@{VERSION}" for j in range(scenario["bins"])]
+
+    profile = goget.Profile()
+    a = goget.GogoGadget(
+        "bench",
+        bins,
+        mods,
+        output,
+        "bench",
+        scenario["compression"],
+        scenario["jobs"],
+        platforms=scenario["platforms"],
+        proxy=scenario["proxy"],
+        indexed=scenario["indexed"],
+        profile=profile,
+    )
+
+    with profile.stage("download_bins"):
+        a.download_bins()
+    with profile.stage("download_mods"):
+        a.download_mods()
+    a.info_file()
+    a.write_tools()
+    # the archive is compressed once: its throughput is that of the whole stage
+    with profile.stage("make_selfextract"):
+        a.make_selfextract()
+
+    stages = {s["name"]: s for s in profile.stages}
+    mods, tar = stages["download_mods"], stages["make_selfextract"]
+    archive = next(output.glob("bench-*.sh"))
+    return dict(
+        scenario,
+        stages=profile.stages,
+        modules_per_s=round(mods.get("modules", 0) / max(mods["wall"], 1e-3), 1),
+        tar_mb_per_s=round(tar.get("bytes_in", 0) / max(tar["wall"], 1e-3) / 1e6, 1),
+        tar_input=tar.get("bytes_in", 0),
+        archive_size=archive.stat().st_size,
+        # kilobytes on Linux
+        max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        max_rss_commands=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark goget.py offline, with a synthetic GOPROXY")
+    parser.add_argument("-n", "--modules", help="number of modules", type=int, action="append")
+    parser.add_argument("-s", "--zip-size", help="random data per module (e.g. 64K)", action="append")
+    parser.add_argument("-F", "--fanout", help="dependencies per module", type=int, action="append")
+    parser.add_argument("-b", "--bins", help="number of binaries", type=int, default=2)
+    parser.add_argument("-c", "--compression", help="compression", choices=goget.COMPRESSORS.keys(), action="append")
+    parser.add_argument("-j", "--jobs", help="parallel jobs", type=int)
+    parser.add_argument("-P", "--platform", help="platform of the binaries", action="append")
+    parser.add_argument("--proxy", help="bundle as a file:// GOPROXY", action="store_true")
+    parser.add_argument("--indexed", help="compress by module and add an index", action="store_true")
+    parser.add_argument("-w", "--workdir", help="fixtures dir", type=Path, default="/tmp/bench")
+    parser.add_argument("-o", "--output", help="results file", type=Path, default="bench-goget.json")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.WARNING)
+
+    if os.environ.get("GOPATH") != "/go":
+        print("GOPATH must be /go: run into the goffline image (./golang.sh bench)")
+        exit(2)
+
+    # one scenario, in its own process for the peak memory: result on stdout
+    if args.scenario:
+        scenario = json.loads(args.scenario)
+        result = run_scenario(scenario, Path(scenario.pop("proxy_dir")), Path(scenario.pop("output_dir")))
+        print(json.dumps(result))
+        return
+
+    results = []
+    for count, zip_size, fanout, compression in itertools.product(
+        args.modules or [100], args.zip_size or ["64K"], args.fanout or [3], args.compression or ["gz"]
+    ):
+        size = goget.parse_size(zip_size)
+        name = f"n{count}-s{size}-f{fanout}-b{args.bins}"
+        proxy = args.workdir / name / "proxy"
+        if not proxy.is_dir():
+            t0 = time.monotonic()
+            make_proxy(proxy, count, size, fanout, args.bins)
+            print(f"fixture {name} generated in {time.monotonic() - t0:.1f}s")
+
+        output = args.workdir / name / "out" / compression
+        if output.is_dir():
+            goget.remove_tree(output)
+        scenario = dict(
+            modules=count,
+            zip_size=size,
+            fanout=fanout,
+            bins=args.bins,
+            compression=compression,
+            jobs=args.jobs,
+            platforms=args.platform or ["linux/amd64"],
+            proxy=args.proxy,
+            indexed=args.indexed,
+        )
+        dirs = dict(proxy_dir=str(proxy), output_dir=str(output))
+        p = subprocess.run(
+            [sys.executable, __file__, "--scenario", json.dumps(dict(scenario, **dirs))],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if p.returncode != 0:
+            print(f"scenario {name} {compression} failed")
+            exit(2)
+        results.append(json.loads(p.stdout.splitlines()[-1]))
+
+    args.output.write_text(json.dumps(results, indent=2))
+
+    print()
+    print(f"{'modules':>8} {'size':>8} {'fanout':>6} {'comp':>9} {'bins s':>7} {'mods s':>7} {'mods/s':>7}", end="")
+    print(f" {'tar MB/s':>8} {'archive':>12} {'rss kB':>8}")
+    for r in results:
+        stages = {s["name"]: s for s in r["stages"]}
+        print(
+            f"{r['modules']:>8} {r['zip_size']:>8} {r['fanout']:>6} {r['compression']:>9}"
+            f" {stages['download_bins']['wall']:>7.1f} {stages['download_mods']['wall']:>7.1f} {r['modules_per_s']:>7}"
+            f" {r['tar_mb_per_s']:>8} {r['archive_size']:>12} {max(r['max_rss'], r['max_rss_commands']):>8}"
+        )
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
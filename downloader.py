@@ -0,0 +1,99 @@
+# Streamed, resumable downloads, shared by vscode-app.py and vscode-ext.py
+
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import requests
+from dateutil.parser import parse as parsedate
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownload(DownloadError):
+    """A download to resume or restart."""
+
+
+def file_hash(file: Path, size):
+    """sha256 of the beginning of a file (the part already downloaded)."""
+    h = hashlib.sha256()
+    if size > 0:
+        with file.open("rb") as f:
+            while size > 0 and (chunk := f.read(min(CHUNK_SIZE, size))):
+                h.update(chunk)
+                size -= len(chunk)
+    return h
+
+
+def download(session, url, file: Path, mtime=None, sha256=None, timeout=60, retries=4):
+    """Download a file in chunks into file.part, and rename it once complete.
+    An interrupted download is resumed with a Range request, by this call or by a next run.
+    The size is checked against Content-Length, and the sha256 if given.
+    The file date is set from mtime (a date string), or from Last-Modified.
+    Return the number of bytes downloaded."""
+
+    part = file.with_name(file.name + ".part")
+    received = 0
+
+    for attempt in range(retries + 1):
+        offset = part.stat().st_size if part.exists() else 0
+        # no transfer compression: Content-Length and Range count the bytes written to the part file
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=(10, timeout)) as r:
+                if r.status_code == 416:
+                    # the part does not match the file anymore: start over
+                    part.unlink()
+                    raise IncompleteDownload("range not satisfiable")
+                if r.status_code == 429 or r.status_code >= 500:
+                    r.raise_for_status()
+                if r.status_code >= 400:
+                    raise DownloadError(f"{r.status_code} {r.reason} for {url}")
+
+                if r.status_code != 206:
+                    # the server ignored the range
+                    offset = 0
+                expected = int(r.headers["Content-Length"]) + offset if "Content-Length" in r.headers else None
+                h = file_hash(part, offset) if sha256 else None
+
+                with part.open("r+b" if offset else "wb") as f:
+                    f.seek(offset)
+                    f.truncate()
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        if h:
+                            h.update(chunk)
+                        received += len(chunk)
+
+                size = part.stat().st_size
+                if expected is not None and size != expected:
+                    raise IncompleteDownload(f"{size} bytes instead of {expected}")
+
+                last_modified = r.headers.get("Last-Modified")
+            break
+
+        except (requests.RequestException, IncompleteDownload) as e:
+            if attempt == retries:
+                raise DownloadError(f"cannot download {file.name}: {e}")
+            delay = 2**attempt
+            print(f"error downloading {file.name}: {e}, retrying in {delay}s")
+            time.sleep(delay)
+
+    if h and h.hexdigest() != sha256.lower():
+        part.unlink()
+        raise DownloadError(f"bad sha256 for {file.name}: {h.hexdigest()}")
+
+    date = mtime or last_modified
+    if date:
+        ns = round(parsedate(date).timestamp() * 1_000_000_000)
+        os.utime(part, ns=(ns, ns))
+
+    part.replace(file)
+    return received
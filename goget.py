@@ -9,23 +9,406 @@ import os
 import subprocess
 import datetime
 import tarfile
-import base64
 import re
 import shutil
 import logging
+import time
+import tempfile
+import concurrent.futures
+import json
+import hashlib
+import threading
+import gzip
+import io
+import contextlib
+import resource
+import cProfile
+
+
+def escape_path(path):
+    """Escape a module path like the Go module cache does (uppercase letters become !lowercase)."""
+    return re.sub(r"([A-Z])", lambda c: "!" + c.group(1).lower(), path)
+
+
+def parse_size(size):
+    """Convert a size like 500M or 20G into bytes."""
+    m = re.match(r"^(\d+(?:\.\d+)?)([KMGT]?)I?B?$", size.strip().upper())
+    if not m:
+        raise ValueError(f"bad size: {size}")
+    return int(float(m[1]) * 1024 ** "_KMGT".index(m[2] or "_"))
+
+
+def remove_tree(path):
+    """Remove a directory tree, even with read-only directories (like the Go module cache)."""
+
+    def onerror(func, path, exc_info):
+        os.chmod(Path(path).parent, 0o755)
+        os.chmod(path, 0o755)
+        func(path)
+
+    shutil.rmtree(path, onerror=onerror)
+
+
+def unescape_path(path):
+    """Reverse of escape_path."""
+    return re.sub(r"(![a-z])", lambda c: c.group(1)[1].upper(), path)
+
+
+def cache_key(path):
+    """Return the escaped (module, version) that owns a file of the module cache, or None."""
+    parts = Path(path).parts
+    if parts[:2] != ("pkg", "mod"):
+        return None
+    parts = parts[2:]
+    if parts[:2] == ("cache", "download"):
+        if "@v" not in parts:
+            return None
+        i = parts.index("@v")
+        if i + 1 >= len(parts):
+            return None
+        version = parts[i + 1]
+        for ext in (".zip", ".mod", ".info", ".ziphash", ".lock"):
+            if version.endswith(ext):
+                return ("/".join(parts[2:i]), version[: -len(ext)])
+        return None
+    for i, part in enumerate(parts):
+        if "@" in part:
+            m, v = part.split("@", 1)
+            return ("/".join(parts[:i] + (m,)), v)
+    return None
+
+
+class GoCache:
+    """Persistent GOMODCACHE and GOCACHE, shared between runs and bounded in size."""
+
+    def __init__(self, cache_dir, max_size=None):
+        self.dir = Path(cache_dir)
+        self.max_size = parse_size(max_size) if max_size else None
+        self.modcache = self.dir / "mod"
+        self.gocache = self.dir / "build"
+        self.lru_file = self.dir / "lru.json"
+        self.modcache.mkdir(parents=True, exist_ok=True)
+        self.gocache.mkdir(parents=True, exist_ok=True)
+
+        # all go subprocesses inherit these variables
+        os.environ["GOMODCACHE"] = str(self.modcache)
+        os.environ["GOCACHE"] = str(self.gocache)
+
+        self.lru = json.loads(self.lru_file.read_text()) if self.lru_file.exists() else {}
+        self.before = self.entries()
+        self.gocache_before = self.tree_size(self.gocache)
+        self.used = set()
+
+    def entries(self):
+        """Return the cached module versions (with a zip, or only go.mod and info) and the size of their files."""
+        dl = self.modcache / "cache/download"
+        entries = {}
+        for f in dl.rglob("*"):
+            if "/@v/" not in str(f.relative_to(dl)) or not f.is_file():
+                continue
+            m, name = str(f.relative_to(dl)).split("/@v/")
+            if name.startswith("list"):
+                continue
+            for ext in (".zip", ".mod", ".info", ".ziphash", ".lock"):
+                if name.endswith(ext):
+                    key = (unescape_path(m), unescape_path(name[: -len(ext)]))
+                    entries[key] = entries.get(key, 0) + f.stat().st_size
+                    break
+        return entries
+
+    def entry_paths(self, m, v):
+        """Files and directories of a module version in GOMODCACHE."""
+        esc = escape_path(m)
+        paths = list((self.modcache / "cache/download" / esc / "@v").glob(f"{escape_path(v)}.*"))
+        src = self.modcache / f"{esc}@{escape_path(v)}"
+        if src.exists():
+            paths.append(src)
+        return paths
+
+    def tree_size(self, path):
+        if path.is_file():
+            return path.stat().st_size
+        return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+    def use(self, modules):
+        """Mark module versions as used by this run."""
+        self.used.update(modules)
+
+    def report(self):
+        """Log the cache statistics for this run."""
+        after = self.entries()
+        hits = [k for k in self.used if k in self.before]
+        misses = [k for k in after if k not in self.before]
+        reused = sum(self.before[k] for k in hits)
+        downloaded = sum(after[k] for k in misses)
+        gocache_after = self.tree_size(self.gocache)
+        logging.info(f"Module cache: {len(hits)} hits ({reused} bytes reused)")
+        logging.info(f"Module cache: {len(misses)} misses ({downloaded} bytes downloaded)")
+        logging.info(f"Build cache: {self.gocache_before} bytes before, {gocache_after} bytes after")
+
+    def evict(self):
+        """Update the LRU data and remove the least recently used entries to fit in max size."""
+        now = time.time()
+        for m, v in self.used | set(self.entries()).difference(self.before):
+            self.lru[f"{m}@{v}"] = now
+
+        # candidates for eviction: module versions (by LRU timestamp), and the build cache files (by mtime)
+        items = []
+        owned = set()
+        # version lists of each module, removed with its last version
+        versions, lists = {}, {}
+        for m, v in self.entries():
+            paths = self.entry_paths(m, v)
+            owned.update(paths)
+            items.append((self.lru.get(f"{m}@{v}", 0), sum(self.tree_size(p) for p in paths), paths, (m, v)))
+            versions[m] = versions.get(m, 0) + 1
+            if m not in lists:
+                lists[m] = list((self.modcache / "cache/download" / escape_path(m) / "@v").glob("list*"))
+                owned.update(lists[m])
+        # the checksum database is kept
+        sumdb = self.modcache / "cache/download/sumdb"
+        owned.add(sumdb)
+        for root in (self.modcache, self.gocache):
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if Path(dirpath, d) not in owned]
+                for f in filenames:
+                    f = Path(dirpath, f)
+                    if f not in owned and f.is_file():
+                        st = f.stat()
+                        items.append((st.st_mtime, st.st_size, [f], None))
+
+        total = sum(i[1] for i in items) + sum(f.stat().st_size for i in lists.values() for f in i)
+        if sumdb.is_dir():
+            total += self.tree_size(sumdb)
+        if self.max_size and total > self.max_size:
+            evicted = 0
+            for ts, size, paths, key in sorted(items, key=lambda i: i[0]):
+                if total <= self.max_size:
+                    break
+                if key:
+                    self.lru.pop(f"{key[0]}@{key[1]}", None)
+                    versions[key[0]] -= 1
+                    if versions[key[0]] == 0:
+                        paths = paths + lists[key[0]]
+                        size += sum(f.stat().st_size for f in lists[key[0]])
+                for path in paths:
+                    if path.is_dir():
+                        remove_tree(path)
+                    else:
+                        path.unlink(missing_ok=True)
+                total -= size
+                evicted += size
+            logging.info(f"Cache eviction: {evicted} bytes freed, {total} bytes left")
+
+        self.lru_file.write_text(json.dumps(self.lru, indent=2, sort_keys=True))
+
+
+def read_manifest(path):
+    """Read the tag and the module list of a previous bundle (self-extracting archive or gomods.txt)."""
+    path = Path(path)
+    if path.suffix == ".sh":
+        info = subprocess.check_output(["sh", path, "-i"]).decode()
+        tag = re.search(r"^tag: (.*)$", info, re.MULTILINE)[1]
+        # -m prints the binaries, an empty line, then the modules
+        lines = subprocess.check_output(["sh", path, "-m"]).decode().split("\n\n", 1)[-1].splitlines()
+    else:
+        lines = path.read_text().splitlines()
+        tag = next((i[7:] for i in lines if i.startswith("# tag: ")), path.suffix[1:])
+    modules = set(i.strip() for i in lines if i.strip() and not i.startswith("#"))
+    return tag, modules
+
+
+def manifest_digest(modules):
+    """Identity of a module list, the same as: grep -v '^#' gomods.txt | LC_ALL=C sort | sha256sum"""
+    return hashlib.sha256("".join(f"{i}\n" for i in sorted(modules)).encode()).hexdigest()
+
+
+# compression command (with the number of threads) and matching decompression command for the extractor
+COMPRESSORS = {
+    "gz": (
+        lambda threads: ["pigz", "-n", f"-p{threads or os.cpu_count()}"] if shutil.which("pigz") else ["gzip", "-n"],
+        "gzip -dc",
+    ),
+    "bz2": (lambda threads: ["bzip2"], "bzip2 -dc"),
+    "xz": (lambda threads: ["xz", f"-T{threads}", "-6"], "xz -dc"),
+    "zstd": (lambda threads: ["zstd", f"-T{threads}", "-10", "-q"], "zstd -dcq"),
+    "zstd-long": (lambda threads: ["zstd", f"-T{threads}", "-19", "--long=27", "-q"], "zstd -dcq --long=27"),
+}
+
+
+# environment variable and allowed values of the platform variant (e.g. linux/arm/v7, linux/amd64/v3)
+PLATFORM_VARIANTS = {
+    "arm": ("GOARM", r"v[567]"),
+    "arm64": ("GOARM64", r"v8\.[0-9]|v9\.[0-5]"),
+    "amd64": ("GOAMD64", r"v[1-4]"),
+    "386": ("GO386", r"sse2|softfloat"),
+    "mips": ("GOMIPS", r"hardfloat|softfloat"),
+    "mipsle": ("GOMIPS", r"hardfloat|softfloat"),
+    "ppc64": ("GOPPC64", r"power(8|9|10)"),
+    "ppc64le": ("GOPPC64", r"power(8|9|10)"),
+    "riscv64": ("GORISCV64", r"rva2[023]u64"),
+}
+
+
+def platform_env(platform):
+    """Return the environment for a platform os/arch[/variant]. Raise ValueError if it is malformed."""
+    fields = platform.split("/")
+    if len(fields) not in (2, 3) or not all(fields):
+        raise ValueError(f"bad platform {platform}, should be os/arch[/variant]")
+    goos, goarch, *variant = fields
+    env = {"GOOS": goos, "GOARCH": goarch}
+    if variant:
+        if goarch not in PLATFORM_VARIANTS:
+            raise ValueError(f"bad platform {platform}, no variant for {goarch}")
+        name, pattern = PLATFORM_VARIANTS[goarch]
+        if not re.fullmatch(pattern, variant[0]):
+            raise ValueError(f"bad platform {platform}, variant of {goarch} should match {pattern}")
+        # GOARM is only the number
+        env[name] = variant[0][1:] if goarch == "arm" else variant[0]
+    return env
+
+
+def platform_dir(platform):
+    """Return the binaries subdir of a platform: os_arch[_variant]."""
+    return platform.replace("/", "_")
+
+
+def gopath(platform, toolchain=None):
+    """GOPATH used to install the binaries of a platform and toolchain."""
+    return f"/tmp/gopath/{toolchain or 'default'}/{platform_dir(platform)}"
+
+
+class HashWriter:
+    """Write-through file object that computes the sha256 of the written data."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+
+class Profile:
+    """Wall and CPU time, bytes and counts of the stages, and time spent in the commands they run."""
+
+    def __init__(self):
+        self.stages = []
+        self.current = None
+        self.lock = threading.Lock()
+        self.t0 = time.monotonic()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure a stage. Stages are sequential, commands and counts are added to the current one."""
+        record = {"name": name, "commands": {}}
+        self.current = record
+        t0, c0 = time.monotonic(), os.times()
+        try:
+            yield record
+        finally:
+            c1 = os.times()
+            record["wall"] = round(time.monotonic() - t0, 3)
+            # CPU time of the interpreter, and of the terminated commands (go, compressor)
+            record["cpu"] = round(c1.user - c0.user + c1.system - c0.system, 3)
+            record["cpu_commands"] = round(
+                c1.children_user - c0.children_user + c1.children_system - c0.children_system, 3
+            )
+            self.stages.append(record)
+            self.current = None
+            logging.debug(f"Stage {name}: {record['wall']}s wall, {record['cpu']}s + {record['cpu_commands']}s CPU")
+
+    def count(self, key, value=1):
+        """Add a value (bytes, modules...) to the current stage."""
+        if self.current is not None:
+            with self.lock:
+                self.current[key] = self.current.get(key, 0) + value
+
+    def run(self, args, **kwargs):
+        """subprocess.run, with the time spent in the command added to the current stage (by command name)."""
+        t0 = time.monotonic()
+        p = subprocess.run(args, **kwargs)
+        self.command(args, time.monotonic() - t0, p.returncode)
+        return p
+
+    def command(self, args, elapsed, returncode):
+        """Add a terminated command to the current stage."""
+        if self.current is not None:
+            with self.lock:
+                c = self.current["commands"].setdefault(
+                    " ".join(args[:2]), {"runs": 0, "failed": 0, "wall": 0, "max": 0}
+                )
+                c["runs"] += 1
+                c["failed"] += returncode != 0
+                c["wall"] = round(c["wall"] + elapsed, 3)
+                c["max"] = round(max(c["max"], elapsed), 3)
+
+    def write(self, path, **info):
+        """Write the JSON report."""
+        report = dict(info)
+        report["wall"] = round(time.monotonic() - self.t0, 3)
+        # kilobytes on Linux
+        report["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report["max_rss_commands"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        report["stages"] = self.stages
+        Path(path).write_text(json.dumps(report, indent=2))
 
 
 class GogoGadget:
-    def __init__(self, name, bins, mods, output=None, tag=None, compression=None):
+    def __init__(
+        self,
+        name,
+        bins,
+        mods,
+        output=None,
+        tag=None,
+        compression=None,
+        jobs=None,
+        cache=None,
+        base=None,
+        threads=None,
+        proxy=False,
+        indexed=False,
+        prune=False,
+        toolchains=None,
+        platforms=None,
+        split=False,
+        profile=None,
+    ):
         self.name = name
         self.output = output or "."
         self.tag = tag or "tag"
-        self.now_iso8601 = datetime.datetime.now().isoformat()
+        # a fixed date (and mtime of the archive members) for reproducible archives
+        self.epoch = int(os.environ["SOURCE_DATE_EPOCH"]) if os.environ.get("SOURCE_DATE_EPOCH") else None
+        if self.epoch is None:
+            self.now_iso8601 = datetime.datetime.now().isoformat()
+        else:
+            self.now_iso8601 = datetime.datetime.fromtimestamp(self.epoch, datetime.timezone.utc).isoformat()
         self.compression = compression or "gz"
+        self.threads = threads or 0
+        self.proxy = proxy
+        self.indexed = indexed
+        self.prune = prune
+        self.jobs = jobs or os.cpu_count()
+        self.platforms = platforms or ["linux/amd64", "linux/arm64"]
+        self.split = split
+        self.cache = cache
+        self.bins_failures = []
+        self.profile = profile or Profile()
+        self.base = None
+        if base:
+            base_tag, base_modules = read_manifest(base)
+            self.base = (base_tag, manifest_digest(base_modules), base_modules)
         self.bins = GogoGadget.ensure_version(bins)
         self.mods = GogoGadget.ensure_version(mods)
         self.GOVERSION = subprocess.check_output(["go", "env", "GOVERSION"]).decode().strip()
+        self.toolchains = toolchains or []
+        self.label = "+".join(self.toolchains) or self.GOVERSION
         self.GOFFLINE_VERSION = os.environ.get("GOFFLINE_VERSION", "master")
+        self.GOMODCACHE = Path(subprocess.check_output(["go", "env", "GOMODCACHE"]).decode().strip())
 
     def ensure_version(mods):
         """Ensure that the version is in the format 'module@version'."""
@@ -36,81 +419,269 @@ class GogoGadget:
             new_mods.add(mod)
         return new_mods
 
-    def downloaded_versions(self):
-
-        dl = Path("/go/pkg/mod/cache/download")
-        for zip in dl.rglob("*.zip"):
-            m, v = str(zip.relative_to(dl)).split("/@v/")
-            m = re.sub(r"(![a-z])", lambda c: c.group(1)[1].upper(), m)
-            v = v[:-4]
-            yield f"{m} {v}"
+    def binary_modules(self):
+        """Return the build information of the installed binaries, from `go version -m`:
+        package path, main module, version and sum, and dependencies."""
+        bins = {}
+        out = self.profile.run(["go", "version", "-m", "/go/bin"], capture_output=True, text=True).stdout
+        for line in out.splitlines():
+            fields = line.split()
+            if not line.startswith("\t"):
+                current = {"path": None, "module": None, "version": None, "sum": None, "deps": []}
+            elif fields[0] == "path":
+                current["path"] = fields[1]
+                bins.setdefault(fields[1], current)
+            elif fields[0] == "mod" and len(fields) >= 3:
+                current.update(module=fields[1], version=fields[2], sum=(fields[3:] or [None])[0])
+            elif fields[0] == "dep" and len(fields) >= 3:
+                current["deps"].append({"path": fields[1], "version": fields[2], "sum": (fields[3:] or [None])[0]})
+        return list(bins.values())
+
+    def module_downloads(self, modules):
+        """Return the `go mod download -json` information of module versions (already in the cache)."""
+        if not modules:
+            return []
+        p = self.profile.run(
+            ["go", "mod", "download", "-json", *(f"{m}@{v}" for m, v in sorted(modules))],
+            cwd="/",
+            capture_output=True,
+            text=True,
+        )
+        # the output is a stream of JSON objects
+        decoder = json.JSONDecoder()
+        infos, pos = [], 0
+        while pos < len(p.stdout):
+            if p.stdout[pos].isspace():
+                pos += 1
+                continue
+            info, pos = decoder.raw_decode(p.stdout, pos)
+            if "Error" in info:
+                logging.warning(f"{info['Path']}@{info['Version']}: {info['Error']}")
+            else:
+                infos.append(info)
+        return infos
+
+    def install_groups(self):
+        """Group the binaries by module root and version, to install them with a single `go install`."""
+        groups = {}
+        for mod in sorted(self.bins):
+            path, version = mod.split("@", 1)
+            # a good guess of the module root: host/owner/repo, except for the major version suffix
+            root = "/".join(path.split("/")[:3])
+            groups.setdefault((root, version), []).append(mod)
+        return list(groups.values())
+
+    def go_install(self, mods, platform, toolchain=None):
+        """Install one or more packages for a given platform, with its own environment.
+        The binaries go into a GOPATH dedicated to the platform and toolchain, the module cache is shared."""
+        env = dict(os.environ, GOPATH=gopath(platform, toolchain), GOMODCACHE=str(self.GOMODCACHE))
+        env.update(platform_env(platform))
+        if toolchain:
+            env.update(GOTOOLCHAIN=toolchain)
+        t0 = time.monotonic()
+        p = self.profile.run(["go", "install", "-ldflags=-s -w", *mods], env=env, capture_output=True, text=True)
+        return p.returncode, time.monotonic() - t0, p.stderr
 
     def download_bins(self):
-        """Install Go modules for both architectures."""
+        """Install Go modules for all architectures, in parallel."""
 
         if not self.bins:
             logging.info("No binary to install")
             self.bins_versions = []
+            self.bins_manifest = []
             return
 
-        logging.info("Installing binaries")
-
-        # download and compile for linux/amd64
-        for arch in ["amd64", "arm64"]:
-            subprocess.run(["go", "env", "-w", f"GOARCH={arch}", "GOOS=linux"])
-            for mod in self.bins:
-                logging.debug(f"Install {mod} for arch {arch}")
-                subprocess.run(["go", "install", "-ldflags=-s -w", mod])
-
-        # move the host arch binaries to the relying subdir
-        hostarch, hostos = subprocess.check_output(["go", "env", "GOHOSTARCH", "GOHOSTOS"]).decode().splitlines()
-
-        b = Path("/go/bin") / f"{hostos}_{hostarch}"
-        b.mkdir(parents=True, exist_ok=True)
-
-        for f in Path("/go/bin").glob("*"):
-            if f.is_file():
-                (b / f.name).unlink(missing_ok=True)
-                f.rename(b / f.name)
-
-        # restore values
-        subprocess.run(["go", "env", "-u", "GOARCH", "GOOS"])
-
-        # find the binaries versions (from the download cache)
-        bins = set(i.split("@")[0] for i in self.bins)
-        self.bins_versions = []
-        for i in self.downloaded_versions():
-            m, v = i.split(" ")
-            for bin in bins:
-                if bin.startswith(m):
-                    self.bins_versions.append(f"{bin} {v}")
-
-        shutil.rmtree("/go/pkg", ignore_errors=True)
+        logging.info(f"Installing binaries with {self.jobs} workers")
+
+        # one job per (group of packages, platform)
+        jobs = [
+            (mods, platform, toolchain)
+            for toolchain in self.toolchains or [None]
+            for platform in self.platforms
+            for mods in self.install_groups()
+        ]
+        failures = []
+
+        t0 = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = {executor.submit(self.go_install, *job): job for job in jobs}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    mods, platform, toolchain = pending.pop(future)
+                    target = platform + (f" ({toolchain})" if toolchain else "")
+                    returncode, elapsed, stderr = future.result()
+                    if returncode == 0:
+                        logging.debug(f"Installed {' '.join(mods)} for {target} in {elapsed:.1f}s")
+                    elif len(mods) > 1:
+                        # packages are not in the same module (or one is broken): retry one by one
+                        logging.debug(f"Group install failed for {target}, retrying individually")
+                        for mod in mods:
+                            job = ([mod], platform, toolchain)
+                            pending[executor.submit(self.go_install, *job)] = job
+                    else:
+                        logging.error(f"Failed to install {mods[0]} for {target} in {elapsed:.1f}s")
+                        logging.error(stderr.strip())
+                        failures.append(f"{mods[0]} {target}")
+
+        logging.info(f"{len(jobs)} install jobs done in {time.monotonic() - t0:.1f}s")
+
+        # the other binaries are bundled, the run fails at the end
+        if failures:
+            logging.error(f"{len(failures)} install(s) failed:")
+            for failure in failures:
+                logging.error(f"  {failure}")
+        self.bins_failures = failures
+
+        # gather the binaries into bin/<os>_<arch>[_<variant>], or bin/<go version>/<os>_<arch>[_<variant>]
+        for toolchain in self.toolchains or [None]:
+            for platform in self.platforms:
+                dest = Path("/go/bin", toolchain or "", platform_dir(platform))
+                for f in Path(gopath(platform, toolchain), "bin").rglob("*"):
+                    if f.is_file():
+                        dest.mkdir(parents=True, exist_ok=True)
+                        shutil.move(f, dest / f.name)
+
+        # find the binaries versions (from the build information)
+        self.bins_manifest = self.binary_modules()
+        self.bins_versions = [f"{i['path']} {i['version']}" for i in self.bins_manifest]
+
+        binaries = [f for f in Path("/go/bin").rglob("*") if f.is_file()]
+        self.profile.count("binaries", len(binaries))
+        self.profile.count("bytes", sum(f.stat().st_size for f in binaries))
+
+        if self.cache:
+            for i in self.bins_manifest:
+                self.cache.use((d["path"], d["version"]) for d in i["deps"])
+                self.cache.use([(i["module"], i["version"])])
+
+        if not self.cache:
+            shutil.rmtree("/go/pkg", ignore_errors=True)
+
+    def go_get(self, mods, workdir):
+        """Resolve a set of modules into a fresh go.mod."""
+        workdir.mkdir(parents=True, exist_ok=True)
+        workdir.joinpath("go.mod").unlink(missing_ok=True)
+        workdir.joinpath("go.sum").unlink(missing_ok=True)
+        self.profile.run(["go", "mod", "init", "download"], cwd=workdir, capture_output=True, check=True)
+        t0 = time.monotonic()
+        p = self.profile.run(["go", "get", *mods], cwd=workdir, capture_output=True, text=True)
+        return p.returncode, time.monotonic() - t0, p.stderr
+
+    def module_graph(self, workdir):
+        """Return the build list (`go list -m all`) and all the module versions of the graph (`go mod graph`)."""
+        out = self.profile.run(
+            ["go", "list", "-m", "-f", "{{.Path}} {{.Version}}", "all"], cwd=workdir, capture_output=True, text=True
+        ).stdout
+        build_list = set(tuple(line.split()) for line in out.splitlines() if len(line.split()) == 2)
+        out = self.profile.run(["go", "mod", "graph"], cwd=workdir, capture_output=True, text=True).stdout
+        graph = set(tuple(i.split("@", 1)) for i in out.split() if "@" in i)
+        return build_list, graph
+
+    def conflicting_mods(self, mods, stderr):
+        """Find the requested modules that are involved in a `go get` error."""
+        culprits = set()
+        for path in re.findall(r"([\w.~-]+(?:/[\w.~-]+)+)@", stderr):
+            for mod in mods:
+                m = mod.split("@", 1)[0]
+                if m == path or m.startswith(path + "/") or path.startswith(m + "/"):
+                    culprits.add(mod)
+        return culprits
 
     def download_mods(self):
-        """Download Go modules."""
+        """Download Go modules, resolving them all at once when possible."""
 
         if not self.mods:
             logging.info("No module to download")
             self.mods_versions = []
+            self.mods_manifest = []
             return
 
         logging.info("Downloading modules")
 
         tmp = Path("/project")
-        tmp.mkdir(parents=True, exist_ok=True)
-        tmp.joinpath("go.mod").unlink(missing_ok=True)
-        subprocess.run(["go", "mod", "init", "download"], cwd=tmp)
-        go_mod = tmp / "go.mod"
-        fresh = go_mod.read_bytes()
-        for mod in self.mods:
-            logging.debug(f"Download {mod}")
-            go_mod.write_bytes(fresh)
-            subprocess.run(["go", "get", mod], cwd=tmp)
-
-        Path(f"/go/gosums.txt.{self.tag}").write_text(tmp.joinpath("go.sum").read_text())
-
-        self.mods_versions = list(self.downloaded_versions())
+        batch = set(self.mods)
+        isolated = set()
+
+        # several versions of a module cannot be in the same go.mod
+        paths = {}
+        for mod in batch:
+            paths.setdefault(mod.split("@", 1)[0], []).append(mod)
+        for versions in paths.values():
+            if len(versions) > 1:
+                isolated.update(versions)
+        batch.difference_update(isolated)
+
+        # resolve the whole set with a single go get, and set aside the conflicting entries
+        while batch:
+            returncode, elapsed, stderr = self.go_get(sorted(batch), tmp)
+            if returncode == 0:
+                logging.debug(f"Resolved {len(batch)} modules in {elapsed:.1f}s")
+                break
+            culprits = self.conflicting_mods(batch, stderr) or batch
+            logging.debug(f"Batch resolution failed, isolating {len(culprits)} module(s)")
+            isolated.update(culprits)
+            batch.difference_update(culprits)
+
+        gosums = set(tmp.joinpath("go.sum").read_text().splitlines()) if batch else set()
+        failures = []
+
+        # modules actually needed, for pruning
+        self.build_list, self.graph = set(), set()
+        if self.prune and batch:
+            self.build_list, self.graph = self.module_graph(tmp)
+
+        # resolve the conflicting entries separately, in parallel
+        if isolated:
+            logging.info(f"Resolving {len(isolated)} module(s) separately")
+            with tempfile.TemporaryDirectory() as workdir:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                    futures = {}
+                    for i, mod in enumerate(sorted(isolated)):
+                        d = Path(workdir) / str(i)
+                        futures[executor.submit(self.go_get, [mod], d)] = (mod, d)
+                    for future in concurrent.futures.as_completed(futures):
+                        mod, d = futures[future]
+                        returncode, elapsed, stderr = future.result()
+                        if returncode == 0:
+                            logging.debug(f"Resolved {mod} in {elapsed:.1f}s")
+                            go_sum = d / "go.sum"
+                            if go_sum.exists():
+                                gosums.update(go_sum.read_text().splitlines())
+                            if self.prune:
+                                build_list, graph = self.module_graph(d)
+                                self.build_list.update(build_list)
+                                self.graph.update(graph)
+                        else:
+                            logging.error(f"Failed to resolve {mod}")
+                            logging.error(stderr.strip())
+                            failures.append(mod)
+
+        if failures:
+            logging.error(f"{len(failures)} module(s) cannot be resolved")
+            exit(2)
+
+        Path(f"/go/gosums.txt.{self.tag}").write_text("".join(f"{i}\n" for i in sorted(gosums)))
+
+        # the modules whose content was needed have a go.sum line (the others have only a /go.mod line)
+        zips = set()
+        for line in gosums:
+            m, v = line.split()[:2]
+            if not v.endswith("/go.mod"):
+                zips.add((m, v))
+
+        if self.prune:
+            zips.intersection_update(self.build_list)
+
+        self.mods_manifest = self.module_downloads(zips)
+        self.mods_versions = [f"{i['Path']} {i['Version']}" for i in self.mods_manifest]
+
+        self.profile.count("modules", len(self.mods_manifest))
+        self.profile.count("gosum_lines", len(gosums))
+        self.profile.count("bytes", sum(Path(i["Zip"]).stat().st_size for i in self.mods_manifest if "Zip" in i))
+
+        if self.cache:
+            self.cache.use(zips)
 
     def info_file(self):
         """Save the module list info a text file."""
@@ -122,13 +693,31 @@ class GogoGadget:
             f.write(f"# tag: {self.tag}\n")
             f.write(f"# date: {self.now_iso8601}\n")
             f.write(f"# goffline: {self.GOFFLINE_VERSION}\n")
-            for v in self.bins_versions:
+            if self.base:
+                f.write(f"# base: {self.base[0]} {self.base[1]}\n")
+            for v in sorted(self.bins_versions):
                 f.write(f"# bin: {v}\n")
-            for v in self.mods_versions:
+            for v in sorted(self.mods_versions):
                 f.write(f"{v}\n")
 
         info.chmod(0o444)
 
+        # the same, machine-readable
+        manifest = {
+            "tag": self.tag,
+            "date": self.now_iso8601,
+            "goffline": self.GOFFLINE_VERSION,
+            "go": self.label,
+            "bins": [{k: v for k, v in i.items() if k != "deps"} for i in self.bins_manifest],
+            "mods": [
+                {"path": i["Path"], "version": i["Version"], "sum": i.get("Sum"), "gomodsum": i.get("GoModSum")}
+                for i in self.mods_manifest
+            ],
+        }
+        if self.base:
+            manifest["base"] = {"tag": self.base[0], "digest": self.base[1]}
+        Path("/go").joinpath(f"gomods.json.{self.tag}").write_text(json.dumps(manifest, indent=2))
+
     def write_tools(self):
         """Write the script to get a go.mod requirement.
         Write the script to update the module versions in go.mod."""
@@ -142,8 +731,42 @@ class GogoGadget:
         findmod.write_text(
             """\
 #!/bin/sh
+# usage: findmod module | findmod -p prefix
 set -e
 test -n "$1"
+if command -v python3 >/dev/null; then
+    exec python3 - "$@" <<'#PYTHON'
+import mmap
+import os
+import sys
+
+# gomods.txt is sorted (LC_ALL=C): binary search of the first line >= key
+prefix = sys.argv[1] == "-p"
+key = sys.argv[-1].encode() + (b"" if prefix else b" ")
+with open("/go/gomods.txt", "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+lo, hi = 0, len(data)
+while lo < hi:
+    start = data.rfind(b"\\n", 0, (lo + hi) // 2) + 1
+    end = data.find(b"\\n", start)
+    end = len(data) if end == -1 else end
+    if data[start:end] < key:
+        lo = end + 1
+    else:
+        hi = start
+while lo < len(data):
+    end = data.find(b"\\n", lo)
+    end = len(data) if end == -1 else end
+    line = data[lo:end]
+    if not line.startswith(key):
+        break
+    print("require " + line.decode())
+    lo = end + 1
+#PYTHON
+fi
+if [ "$1" = "-p" ]; then
+    exec awk -v a="$2" '{ if (index($1, a) == 1) print "require " $0 }' /go/gomods.txt
+fi
 exec awk -v a="$1" '{ if ($1==a) print "require " $0 }' /go/gomods.txt
 """
         )
@@ -156,62 +779,136 @@ exec awk -v a="$1" '{ if ($1==a) print "require " $0 }' /go/gomods.txt
 exec $(which python3 || which python || which false) - <<'#PYTHON' "$@"
 from __future__ import print_function
 import argparse
-from os.path import exists
+import os
+from os.path import exists, join, dirname, abspath
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_gomods(filename):
+    # read the module versions of gomods.txt into a dict
+    modules = {}
+    for line in open(filename):
+        line = line.strip()
+        if line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) == 2:
+            modules[fields[0]] = fields[1]
+    return modules
+
+
+def update_gomod(gomod, modules):
+    # update the versions of the require directives of a go.mod
+    # return the new content and the list of updated modules
+    lines = []
+    updated = []
+    in_require = False
+    for line in open(gomod):
+        code, sep, comment = line.rstrip("\\n").partition("//")
+        fields = code.split()
+        entry = None
+        if in_require:
+            if fields == [")"]:
+                in_require = False
+            elif len(fields) == 2:
+                entry = fields
+        elif fields[:1] == ["require"]:
+            if fields[1:] == ["("]:
+                in_require = True
+            elif len(fields) == 3:
+                entry = fields[1:]
+        if entry and entry[0] in modules and modules[entry[0]] != entry[1]:
+            name, version = entry[0], modules[entry[0]]
+            indent = code[: len(code) - len(code.lstrip())]
+            prefix = "require " if not in_require else ""
+            comment = comment.strip()
+            if comment.startswith("indirect"):
+                comment = "indirect; updated"
+            else:
+                comment = "updated"
+            line = "{}{}{} {} // {}\\n".format(indent, prefix, name, version, comment)
+            updated.append(name + " " + version)
+        lines.append(line)
+    return "".join(lines), updated
+
+
+def find_gomods(root):
+    # find the go.mod files of a tree, and the ones used by the go.work files
+    gomods = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in ("vendor", "node_modules", "testdata") and d[0] != "."]
+        if "go.mod" in filenames:
+            gomods.add(abspath(join(dirpath, "go.mod")))
+        if "go.work" in filenames:
+            in_use = False
+            for line in open(join(dirpath, "go.work")):
+                fields = line.split("//")[0].split()
+                if in_use:
+                    if fields == [")"]:
+                        in_use = False
+                    elif fields:
+                        gomods.add(abspath(join(dirpath, fields[0], "go.mod")))
+                elif fields[:1] == ["use"]:
+                    if fields[1:] == ["("]:
+                        in_use = True
+                    elif len(fields) == 2:
+                        gomods.add(abspath(join(dirpath, fields[1], "go.mod")))
+    return sorted(i for i in gomods if exists(i))
+
+
+def process(gomod, modules, write):
+    content, updated = update_gomod(gomod, modules)
+    if updated and write:
+        open(gomod, "w").write(content)
+        go_sum = join(dirname(gomod), "go.sum")
+        if exists(go_sum) and exists("/go/gosums.txt"):
+            open(go_sum, "w").write(open("/go/gosums.txt").read())
+    return gomod, updated
 
 
 def main():
     parser = argparse.ArgumentParser(description="Update the mod list.")
     parser.add_argument("-w", "--write", action="store_true", help="Write go.mod if updated")
-    parser.add_argument("gomod", help="Path to go.mod", default="go.mod", type=str, nargs="?")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Update all go.mod and go.work of a tree")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Parallel jobs with --recursive")
+    parser.add_argument("gomod", help="Path to go.mod (or directory with -r)", type=str, nargs="?")
     args = parser.parse_args()
 
     if not exists("/go/gomods.txt"):
         print("/go/gomods.txt not found")
         return
 
-    if not exists(args.gomod):
-        print("{} not found".format(args.gomod))
-        return
+    if args.recursive:
+        gomods = find_gomods(args.gomod or ".")
+    else:
+        gomods = [args.gomod or "go.mod"]
 
-    modules = {}
-    for line in open("/go/gomods.txt"):
-        line = line.strip()
-        if line.startswith("#"):
-            continue
-        p = line.find(" ")
-        if p != -1:
-            name = line[:p]
-            version = line[p + 1 :]
-            modules[name] = version
+    for gomod in gomods:
+        if not exists(gomod):
+            print("{} not found".format(gomod))
+            return
 
-    gomods = []
-    updated = []
-    for line in open(args.gomod):
-        for name in modules:
-            p = line.find(name)
-            if p != -1:
-                version = modules[name]
-                if version not in line:
-                    line = f"{line[:p]}{name} {version} // updated\\n"
-                    updated.append(name + " " + version)
-                    break
-        gomods.append(line)
-
-    if len(updated) > 0:
-        print("Module updated:")
-        for line in updated:
-            print("  " + line)
-        if args.write:
-            open(args.gomod, "w").write("".join(gomods))
-            print(f"{args.gomod} updated")
-            go_sum = args.gomod.replace("go.mod", "go.sum")
-            if exists(go_sum) and exists("/go/gosums.txt"):
-                open(go_sum, "w").write(open("/go/gosums.txt").read())
-                print(f"{go_sum} updated")
+    modules = read_gomods("/go/gomods.txt")
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda gomod: process(gomod, modules, args.write), gomods))
+
+    count = 0
+    for gomod, updated in results:
+        if updated:
+            count += 1
+            print("{}: {} module(s) updated".format(gomod, len(updated)))
+            for line in updated:
+                print("  " + line)
+            if args.write:
+                print("{} updated".format(gomod))
         else:
-            print("Run with -w to update {}".format(args.gomod))
-    else:
-        print("{} is ok".format(args.gomod))
+            print("{} is ok".format(gomod))
+
+    if len(results) > 1:
+        print("{} go.mod file(s), {} to update".format(len(results), count))
+    if count > 0 and not args.write:
+        print("Run with -w to update")
 
 
 if __name__ == "__main__":
@@ -222,13 +919,85 @@ if __name__ == "__main__":
         )
         updategomod.chmod(0o755)
 
-    def make_tar(self):
-        """Make the tar archive."""
+    def members(self):
+        """Yield the files of the archive: (path or None for an empty file, arcname, owner).
+        The owner is module@version for the module cache files, module@ for the version lists of a module,
+        bin for the binaries, - otherwise."""
+
+        it = sorted(Path("/go").rglob("*") if self.mods else Path("/go/bin").rglob("*"))
+
+        # module versions seen by the resolution but not in the build list: only the go.mod may be needed
+        self.pruned = [0, 0]
+
+        def needed(key, arcname):
+            m, v = unescape_path(key[0]), unescape_path(key[1])
+            if (m, v) in self.build_list:
+                return True
+            in_download = arcname.parts[2:4] == ("cache", "download")
+            return in_download and arcname.suffix in (".mod", ".info") and (m, v) in self.graph
+
+        # modules already shipped by the base bundle
+        skip = set()
+        if self.base:
+            for i in self.base[2]:
+                m, v = i.split(" ")
+                skip.add((escape_path(m), escape_path(v)))
+            logging.info(f"Delta against {self.base[0]}: {len(skip)} modules skipped")
+
+        def member(f, arcname):
+            key = cache_key(arcname)
+            if key in skip:
+                return
+            if key and self.prune and self.mods and not needed(key, arcname):
+                self.pruned[0] += 1
+                self.pruned[1] += f.stat().st_size
+                return
+            if self.proxy and arcname.parts[:2] == ("pkg", "mod"):
+                # only the download cache, laid out as a GOPROXY, without the extracted sources
+                if arcname.parts[2:4] != ("cache", "download") or arcname.suffix in (".lock", ".ziphash"):
+                    return
+                if arcname.name == "list":
+                    return
+                arcname = Path("proxy", *arcname.parts[4:])
+            if key:
+                owner = f"{unescape_path(key[0])}@{unescape_path(key[1])}"
+            elif arcname.parts[2:4] == ("cache", "download") and arcname.parent.name == "@v":
+                # installed with any version of the module
+                owner = f"{unescape_path('/'.join(arcname.parts[4:-2]))}@"
+            else:
+                owner = "bin" if arcname.parts[0] == "bin" else "-"
+            yield f, arcname, owner
+
+        for f in it:
+            if f.is_file():
+                yield from member(f, f.relative_to("/go"))
+
+        # the persistent cache holds more than needed: add only the modules of this run
+        if self.cache and self.mods:
+            for f in self.cache_files():
+                yield from member(f, Path("pkg/mod") / f.relative_to(self.GOMODCACHE))
 
-        logging.info(f"Make archive with {self.compression} compression")
+        # the checksum database is served by the proxy, with the last known signed tree head
+        if self.proxy and self.mods:
+            latest = Path(os.environ["GOPATH"]) / "pkg/sumdb/sum.golang.org/latest"
+            if latest.is_file():
+                yield latest, Path("proxy/sumdb/sum.golang.org/latest"), "-"
+            yield None, Path("proxy/sumdb/sum.golang.org/supported"), "-"
+
+    def compress(self, members, fileobj):
+        """Write a compressed tar stream of the members into a file object."""
+
+        # the tar stream is piped into the compressor, its output is copied into the file object
+        command = COMPRESSORS[self.compression][0](self.threads)
+        t0 = time.monotonic()
+        compressor = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
-        # create the archive
-        archive = Path("/tmp/go-modules.tar")
+        def copy_output():
+            while data := compressor.stdout.read(1024 * 1024):
+                fileobj.write(data)
+
+        copier = threading.Thread(target=copy_output)
+        copier.start()
 
         def chmod_all(i: tarfile.TarInfo) -> tarfile.TarInfo:
             """Equivalent to chmod a+rX: add owner permission for all, except write."""
@@ -236,44 +1005,175 @@ if __name__ == "__main__":
             i.mode = i.mode | (a << 3) | a
             return i
 
-        it = Path("/go").rglob("*") if self.mods else Path("/go/bin").rglob("*")
+        def normalize(i: tarfile.TarInfo) -> tarfile.TarInfo:
+            """Same owner for all, and the fixed date if any: the archive depends only on the content."""
+            i.uid = i.gid = 0
+            i.uname = i.gname = ""
+            i.mtime = int(i.mtime) if self.epoch is None else self.epoch
+            self.profile.count("files")
+            self.profile.count("bytes_in", i.size)
+            return chmod_all(i)
+
+        with tarfile.open(fileobj=compressor.stdin, mode="w|") as tar:
+            for f, arcname, _ in members:
+                if f is None:
+                    empty = tarfile.TarInfo(str(arcname))
+                    empty.mode = 0o444
+                    empty.mtime = int(time.time())
+                    tar.addfile(normalize(empty))
+                else:
+                    tar.add(f, arcname=arcname, filter=normalize)
+
+        compressor.stdin.close()
+        copier.join()
+        self.profile.command(command, time.monotonic() - t0, compressor.wait())
+        if compressor.returncode != 0:
+            logging.error(f"Compression failed with code {compressor.returncode}")
+            exit(2)
+
+    def make_tar(self, fileobj, platform=None):
+        """Stream the compressed tar archive into a file object.
+        With split archives, the binaries of a platform, or everything except the binaries."""
 
-        with tarfile.open(archive, f"w:{self.compression}") as tar:
-            for f in it:
-                if f.is_file():
-                    tar.add(f, arcname=f.relative_to("/go"), filter=chmod_all)
+        logging.info(f"Make archive with {self.compression} compression")
 
-    def make_selfextract(self):
-        """Make a self-extracting archive."""
+        members = self.members()
+        if platform:
+            members = (i for i in members if i[2] == "bin" and i[1].parts[-2] == platform_dir(platform))
+        elif self.split:
+            members = (i for i in members if i[2] != "bin")
 
-        compression_letter = {"gz": "z", "bz2": "j", "xz": "J"}[self.compression]
-        mode = "bin" if len(self.mods) == 0 else "mod"
+        if not self.indexed:
+            self.compress(members, fileobj)
+        else:
+            self.make_chunks(members, fileobj)
+
+        if self.prune and self.mods:
+            logging.info(f"Pruning: {self.pruned[0]} files not in the build list, {self.pruned[1]} bytes saved")
+
+    def make_chunks(self, members, fileobj):
+        """Write the members as one compressed chunk per owner, then the index after the chunks."""
+
+        chunks = {}
+        for member in members:
+            chunks.setdefault(member[2], []).append(member)
+
+        index = io.StringIO()
+        for owner in sorted(chunks):
+            offset = fileobj.size
+            self.compress(chunks[owner], fileobj)
+            index.write(f"{offset} {fileobj.size - offset} {owner}\n")
+            for _, arcname, _ in chunks[owner]:
+                index.write(f"  {arcname}\n")
+
+        # gzipped index, then a fixed size footer with its position
+        offset = fileobj.size
+        fileobj.write(gzip.compress(index.getvalue().encode(), mtime=0))
+        fileobj.write(b"#INDEX %10d %10d\n" % (offset, fileobj.size - offset))
+        logging.info(f"Archive index: {len(chunks)} chunks")
+
+    def cache_files(self):
+        """Files of the persistent module cache that belong to the module list."""
+        paths = [self.GOMODCACHE / "cache/download/sumdb"]
+        for i in self.mods_versions:
+            m, v = i.split(" ")
+            paths.extend(self.cache.entry_paths(m, v))
+            # the go.mod files of the module graph, and the version lists
+            esc = self.GOMODCACHE / "cache/download" / escape_path(m) / "@v"
+            paths.extend(esc.glob("list*"))
+        for line in Path(f"/go/gosums.txt.{self.tag}").read_text().splitlines():
+            m, v = line.split()[:2]
+            if v.endswith("/go.mod"):
+                v = v.removesuffix("/go.mod")
+                esc = self.GOMODCACHE / "cache/download" / escape_path(m) / "@v"
+                paths.extend(esc / f"{escape_path(v)}.{ext}" for ext in ("mod", "info"))
+        for path in sorted(set(paths)):
+            if path.is_dir():
+                yield from sorted(f for f in path.rglob("*") if f.is_file())
+            elif path.is_file():
+                yield path
+
+    def make_selfextract(self, platform=None):
+        """Make a self-extracting archive (or with split archives, the archive of a platform binaries)."""
+
+        decompress = COMPRESSORS[self.compression][1]
+        if platform:
+            platforms = [platform]
+        elif self.split:
+            platforms = []
+        else:
+            platforms = self.platforms
+        plat_dirs = [platform_dir(i) for i in platforms]
+        bin_dirs = [f"{tc}/{i}" if tc else i for tc in self.toolchains or [None] for i in plat_dirs]
+        mode = "bin" if len(self.mods) == 0 or platform else "proxy" if self.proxy else "mod"
+        base_tag, base_digest = self.base[:2] if self.base else ("", "")
 
         list_bins = "\n".join(f"    echo '{i}'" for i in sorted(self.bins_versions))
         list_mods = "\n".join(f"    echo '{i}'" for i in sorted(self.mods_versions))
 
         script = f"""\
 #!/bin/sh
+indexed={int(self.indexed)}
+only=
+while [ "$1" = "--only" ]; do
+    if [ $indexed = 0 ]; then
+        echo >&2 "--only needs an indexed archive"
+        exit 2
+    fi
+    only="$only $2"
+    shift 2
+done
+index()
+{{
+    set -- $(tail -c 29 "$0")
+    tail -c +$(($2 + 1)) "$0" | head -c $3 | gzip -dc
+}}
+payload()
+{{
+    if [ $indexed = 0 ]; then
+        tail -c +@@OFFSET@@ "$0"
+    elif [ -z "$only" ]; then
+        set -- $(tail -c 29 "$0")
+        local start=$(index | head -1 | cut -d' ' -f1)
+        tail -c +$((${{start:-$2}} + 1)) "$0" | head -c $(($2 - ${{start:-$2}}))
+    else
+        # common and binaries chunks, and the chunks of the selected modules
+        index | awk -v only="$only" '
+            /^ / {{ next }}
+            $3 == "-" || $3 == "bin" {{ print $1, $2; next }}
+            {{ n = split(only, m, " "); for (i = 1; i <= n; i++) if (index($3, m[i] "@") == 1) {{ print $1, $2; next }} }}
+        ' | while read off size; do
+            tail -c +$((off + 1)) "$0" | head -c $size
+        done
+    fi
+}}
 if [ "$1" = "-m" ]; then
 {list_bins}
     echo
 {list_mods}
     exit
 elif [ "$1" = "-i" ]; then
-    echo "version: {self.GOVERSION}"
+    echo "version: {self.label}"
     echo "tag: {self.tag}"
     echo "date: {self.now_iso8601}"
     echo "goffline: {self.GOFFLINE_VERSION}"
+    if [ -n "{base_tag}" ]; then
+        echo "base: {base_tag} {base_digest}"
+    fi
     exit
 elif [ "$1" = "-t" ]; then
+    if [ $indexed = 1 ]; then
+        index | sed -n 's/^  //p'
+        exit
+    fi
     fn()
     {{
-        tar -t{compression_letter}
+        {decompress} | tar -t
     }}
 elif [ "$1" = "-tv" ]; then
     fn()
     {{
-        tar -tv{compression_letter}
+        {decompress} | tar -tv --ignore-zeros
     }}
 elif [ "$1" = "-x" ]; then
     fn()
@@ -281,7 +1181,7 @@ elif [ "$1" = "-x" ]; then
         cat
     }}
 elif [ -n "$1" ]; then
-    echo "Usage: $0 [option]"
+    echo "Usage: $0 [--only module]... [option]"
     echo "  -x     extract to stdin"
     echo "  -t[v]  list content"
     echo "  -i     display information"
@@ -291,42 +1191,238 @@ else
     fn()
     {{
         local ver=$(go env GOVERSION)
-        if [ "$ver" != "{self.GOVERSION}" ]; then
-            echo >&2 "Go version mismatch"
-            echo >&2 "Found:    $ver"
-            echo >&2 "Expected: {self.GOVERSION}"
-            exit 2
+        case " {" ".join(self.toolchains) or self.GOVERSION} " in
+            *" $ver "*) ;;
+            *)
+                echo >&2 "Go version mismatch"
+                echo >&2 "Found:    $ver"
+                echo >&2 "Expected: {self.label}"
+                exit 2
+                ;;
+        esac
+        if [ -n "{base_tag}" ]; then
+            local base=$(go env GOPATH)/gomods.txt.{base_tag}
+            if [ ! -f $base ] || [ "$(grep -v '^#' $base | LC_ALL=C sort | sha256sum | cut -d' ' -f1)" != "{base_digest}" ]; then
+                echo >&2 "This is a delta archive, base bundle {base_tag} is missing or different"
+                exit 2
+            fi
         fi
-        local arch=$(go env GOHOSTARCH)
-        if [ $arch = amd64 ]; then exclude=arm64; else exclude=amd64; fi
-        tar -C $(go env GOPATH) \\
-            -x{compression_letter} \\
+        # keep only the binaries of the host platform (and toolchain), or the first variant of it
+        local plat=$(go env GOHOSTOS)_$(go env GOHOSTARCH)
+        local variant=
+        for b in {" ".join(plat_dirs)}; do
+            case $b in ${{plat}}_*) variant=${{variant:-$b}} ;; esac
+        done
+        case " {" ".join(plat_dirs)} " in *" $plat "*) ;; *) plat=${{variant:-$plat}} ;; esac
+        local host={"$ver/" if self.toolchains else ""}$plat
+        set --
+        for b in {" ".join(bin_dirs)}; do
+            if [ $b != $host ]; then set -- "$@" --exclude="bin/$b/*"; fi
+        done
+        if [ -n "{" ".join(bin_dirs)}" ] && [ $# = {len(bin_dirs)} ]; then
+            echo >&2 "No binaries for $host"
+        fi
+        {decompress} | tar -C $(go env GOPATH) \\
+            -x \\
+            --ignore-zeros \\
             --no-same-owner \\
-            --transform="s,bin/linux_$arch,bin," \\
-            --exclude="bin/linux_$exclude*"
+            --transform="s,^bin/$host,bin," \\
+            "$@"
         if [ {mode} != bin ]; then
             cd $(go env GOPATH)
-            cat gomods.txt.* | sort -u | grep -v "^# [dg]" > gomods.txt
-            cat gosums.txt.* | sort -u > gosums.txt
-            chmod 444 gomods.txt
+            if [ -n "$only" ]; then
+                # the lists of this bundle keep only the selected modules
+                for f in gomods.txt.{self.tag} gosums.txt.{self.tag}; do
+                    awk -v only="$only" '
+                        BEGIN {{ n = split(only, m, " "); for (i = 1; i <= n; i++) selected[m[i]] = 1 }}
+                        /^#/ || $1 in selected
+                    ' $f > .$f.new
+                    mv -f .$f.new $f
+                done
+            fi
+            # merge the sorted lines of stdin into the sorted list of the installed bundles
+            merge()
+            {{
+                if [ -f $1 ] && LC_ALL=C sort -c $1 2>/dev/null; then
+                    LC_ALL=C sort -u | LC_ALL=C sort -m -u $1 - > .$1.new
+                else
+                    cat $1.* | grep -Ev "^# (date|goffline|base):" | LC_ALL=C sort -u > .$1.new
+                fi
+                chmod 444 .$1.new
+                mv -f .$1.new $1
+            }}
+            grep -Ev "^# (date|goffline|base):" gomods.txt.{self.tag} | merge gomods.txt
+            merge gosums.txt < gosums.txt.{self.tag}
+        fi
+        if [ {mode} = proxy ]; then
+            # version lists of the proxy, from all installed bundles
+            find proxy -type d -name @v | while read d; do
+                ls $d | sed -n 's/\\.info$//p' | LC_ALL=C sort > $d/list
+            done
+            go env -w GOPROXY=file://$(go env GOPATH)/proxy GOFLAGS=-mod=mod
         fi
     }}
 fi
-base64 -d <<'#EOF#' | fn
+payload | fn
+exit $?
 """
 
-        selfextract = Path(self.output) / f"{self.name}-{self.GOVERSION}-{self.tag}.sh"
-        tar = Path("/tmp/go-modules.tar")
+        # the payload starts right after the script: the placeholder has the width of the offset
+        script = script.encode()
+        script = script.replace(b"@@OFFSET@@", b"%010d" % (len(script) + 1))
 
-        logging.info(f"Create self-extracting archive {selfextract}")
+        suffix = f"-{platform_dir(platform)}" if platform else ""
+        selfextract = Path(self.output) / f"{self.name}-{self.label}-{self.tag}{suffix}.sh"
+        digest_file = selfextract.parent / ("." + selfextract.stem + ".digest")
 
-        with tar.open("rb") as tarf:
-            with selfextract.open("wb") as sfx:
-                sfx.write(script.encode())
-                base64.encode(tarf, sfx)
-                sfx.write("#EOF#".encode())
+        # do not rebuild archive if up to date
+        digest_hexvalue = self.input_digest(platform)
+        if selfextract.is_file():
+            if digest_file.is_file():
+                if digest_file.read_text() == digest_hexvalue:
+                    logging.info(f"Archive {selfextract} is up to date")
+                    self.profile.count("up_to_date")
+                    return
+                digest_file.unlink()
 
-        selfextract.chmod(0o755)
+        logging.info(f"Create self-extracting archive {selfextract}")
+
+        # written aside, so that an interrupted run does not leave a truncated archive
+        part = selfextract.with_name(selfextract.name + ".part")
+        with part.open("wb") as sfx:
+            out = HashWriter(sfx)
+            out.write(script)
+            self.make_tar(out, platform)
+
+        part.chmod(0o755)
+        part.replace(selfextract)
+        self.profile.count("bytes", out.size)
+
+        Path(f"{selfextract}.sha256").write_text(f"{out.sha256.hexdigest()}  {selfextract.name}\n")
+
+        digest_file.write_text(digest_hexvalue)
+
+    def input_digest(self, platform=None):
+        """Compute a hash of everything the archive is made of: resolved modules and binaries, and options."""
+        sha = hashlib.sha256()
+        options = [
+            self.label,
+            self.tag,
+            self.GOFFLINE_VERSION,
+            self.compression,
+            self.proxy,
+            self.indexed,
+            self.prune,
+            self.split,
+            platform,
+            self.platforms,
+            self.base[1] if self.base else None,
+        ]
+        sha.update(json.dumps(options).encode())
+        for i in sorted(self.bins_versions) + sorted(self.mods_versions):
+            sha.update(f"{i}\n".encode())
+        gosums = Path(f"/go/gosums.txt.{self.tag}")
+        if gosums.is_file():
+            sha.update(gosums.read_bytes())
+        return sha.hexdigest()
+
+    def load_checkpoint(self, resume=False):
+        """Read the stages completed by a previous run with the same options, or start over.
+        The stages are recorded only if resume is set."""
+        self.resume = resume
+        self.resume_dir = Path(self.output) / f".{self.name}-{self.label}-{self.tag}.resume"
+        options = {
+            "bins": sorted(self.bins),
+            "mods": sorted(self.mods),
+            "platforms": self.platforms,
+            "toolchains": self.toolchains,
+            "prune": self.prune,
+        }
+        state_file = self.resume_dir / "state.json"
+        if resume and state_file.is_file():
+            state = json.loads(state_file.read_text())
+            if state["options"] == options:
+                self.state = state
+                logging.info(f"Resuming after {', '.join(state['stages']) or 'nothing'}")
+                return
+            logging.warning("Options have changed, cannot resume")
+        if self.resume_dir.is_dir():
+            remove_tree(self.resume_dir)
+        if resume:
+            self.resume_dir.mkdir(parents=True)
+        self.state = {"options": options, "stages": {}}
+
+    def checkpoint(self, stage):
+        """Record a completed stage, and what is needed to restore it, into the output dir."""
+        if not self.resume:
+            return
+        if stage == "download_bins":
+            if Path("/go/bin").is_dir():
+                shutil.copytree("/go/bin", self.resume_dir / "bin", dirs_exist_ok=True)
+            results = {
+                "bins_manifest": self.bins_manifest,
+                "bins_versions": self.bins_versions,
+                "bins_failures": self.bins_failures,
+            }
+        elif stage == "download_mods":
+            gosums = Path(f"/go/gosums.txt.{self.tag}")
+            if gosums.is_file():
+                shutil.copy(gosums, self.resume_dir / gosums.name)
+            results = {
+                "mods_versions": self.mods_versions,
+                "build_list": sorted(getattr(self, "build_list", [])),
+                "graph": sorted(getattr(self, "graph", [])),
+            }
+        self.state["stages"][stage] = results
+        state_file = self.resume_dir / "state.json"
+        state_file.with_suffix(".tmp").write_text(json.dumps(self.state))
+        state_file.with_suffix(".tmp").replace(state_file)
+
+    def restore(self, stage):
+        """Restore a stage completed by a previous run. Return False if the stage has to be run."""
+        if stage not in self.state["stages"]:
+            return False
+        results = self.state["stages"][stage]
+        logging.info(f"Restoring {stage} from {self.resume_dir}")
+
+        if stage == "download_bins":
+            if self.resume_dir.joinpath("bin").is_dir():
+                shutil.copytree(self.resume_dir / "bin", "/go/bin", dirs_exist_ok=True)
+            self.bins_manifest = results["bins_manifest"]
+            self.bins_versions = results["bins_versions"]
+            self.bins_failures = results["bins_failures"]
+            if self.cache:
+                for i in self.bins_manifest:
+                    self.cache.use((d["path"], d["version"]) for d in i["deps"])
+                    self.cache.use([(i["module"], i["version"])])
+
+        elif stage == "download_mods":
+            self.build_list = set(map(tuple, results["build_list"]))
+            self.graph = set(map(tuple, results["graph"]))
+            gosums = self.resume_dir / f"gosums.txt.{self.tag}"
+            if gosums.is_file():
+                shutil.copy(gosums, "/go")
+            # the exact versions are downloaded again if the module cache did not survive:
+            # content of the archived modules, only go.mod for the others of the graph
+            zips = set(tuple(i.split()) for i in results["mods_versions"])
+            mod_only = set()
+            for line in gosums.read_text().splitlines() if gosums.is_file() else []:
+                m, v = line.split()[:2]
+                if v.endswith("/go.mod") and (m, v[: -len("/go.mod")]) not in zips:
+                    mod_only.add(f"{m}@{v[: -len('/go.mod')]}")
+            if mod_only:
+                self.profile.run(["go", "list", "-m", "-json", *sorted(mod_only)], cwd="/", capture_output=True)
+            self.mods_manifest = self.module_downloads(zips)
+            self.mods_versions = [f"{i['Path']} {i['Version']}" for i in self.mods_manifest]
+            if self.cache:
+                self.cache.use(zips)
+
+        return True
+
+    def complete(self):
+        """The run is complete: the checkpoints are no longer needed."""
+        if self.resume_dir.is_dir():
+            remove_tree(self.resume_dir)
 
 
 def vscode_ext_tools():
@@ -371,8 +1467,9 @@ def vscode_ext_tools():
     return bins
 
 
-def section(conf_file, name, force_latest=False):
+def section(conf_file, name, force_latest=False, raw=False):
     values = set()
+    raw_values = []
     in_section = False
     for i in conf_file.read_text().splitlines():
         i = i.strip()
@@ -382,6 +1479,10 @@ def section(conf_file, name, force_latest=False):
             in_section = i.startswith(f"[{name}]")
         else:
             if in_section:
+                if raw:
+                    # values as is, in order
+                    raw_values.append(i)
+                    continue
                 if " " in i:
                     i = i.split(" ", 1)
                     i = i[0].strip() + "@" + i[1].strip()
@@ -389,7 +1490,87 @@ def section(conf_file, name, force_latest=False):
                     i = i.split("@", 1)[0]
                     i = f"{i}@latest"
                 values.add(i)
-    return list(values)
+    return raw_values if raw else list(values)
+
+
+def go_directives(path):
+    """Parse a go.mod or go.work file into (directive, fields), the blocks being expanded."""
+    block = None
+    for line in Path(path).read_text().splitlines():
+        fields = [i.strip('"`') for i in line.split("//", 1)[0].split()]
+        if not fields:
+            continue
+        if block:
+            if fields == [")"]:
+                block = None
+            else:
+                yield block, fields
+        elif fields[1:] == ["("]:
+            block = fields[0]
+        else:
+            yield fields[0], fields[1:]
+
+
+def module_requirements(path):
+    """Return the required (module, version) of a go.mod or go.work, with its replace directives applied.
+    Modules replaced by a local directory are not needed."""
+    requires, replaces, uses = set(), {}, []
+    for directive, fields in go_directives(path):
+        if directive == "require" and len(fields) == 2:
+            requires.add(tuple(fields))
+        elif directive == "replace" and "=>" in fields:
+            old, new = fields[: fields.index("=>")], fields[fields.index("=>") + 1 :]
+            replaces[tuple(old)] = tuple(new)
+        elif directive == "use" and fields:
+            uses.append(Path(path).parent / fields[0] / "go.mod")
+
+    needed = set()
+    for m, v in requires:
+        new = replaces.get((m, v), replaces.get((m,)))
+        if new is None:
+            needed.add((m, v))
+        elif len(new) == 2:
+            needed.add(new)
+    return needed, replaces, uses
+
+
+def scan_sources(roots):
+    """Collect the exact module versions required by the go.mod and go.work files of source trees."""
+    files = []
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if d not in ("vendor", "node_modules", "testdata") and d[0] != ".")
+            files.extend(Path(dirpath) / f for f in ("go.work", "go.mod") if f in filenames)
+
+    requirements = {}
+    work_replaces = {}
+    for f in files:
+        needed, replaces, uses = module_requirements(f)
+        requirements[f.resolve()] = needed
+        for gomod in uses:
+            # go.work replaces apply to the modules of the workspace, that can be outside the trees
+            work_replaces[gomod.resolve()] = replaces
+            if gomod.is_file() and gomod.resolve() not in requirements:
+                requirements[gomod.resolve()] = module_requirements(gomod)[0]
+
+    # the modules of the trees and of the workspaces are local, like the targets of local replaces
+    local = set()
+    for f in requirements:
+        if f.name == "go.mod":
+            local.update(fields[0] for directive, fields in go_directives(f) if directive == "module" and fields)
+
+    mods = set()
+    for f, needed in requirements.items():
+        replaces = work_replaces.get(f, {})
+        for m, v in needed:
+            if m in local:
+                continue
+            new = replaces.get((m, v), replaces.get((m,), (m, v)))
+            if len(new) == 2:
+                mods.add(f"{new[0]}@{new[1]}")
+
+    logging.info(f"{len(mods)} module versions required by {len(requirements)} go.mod/go.work files")
+    return sorted(mods)
 
 
 def main():
@@ -399,12 +1580,30 @@ def main():
     parser.add_argument("-n", "--name", help="basename", type=str, default="go")
     parser.add_argument("-o", "--output", help="output dir", type=Path)
     parser.add_argument("-t", "--tag", help="tag")
-    parser.add_argument("-c", "--compression", help="compression")
+    parser.add_argument("-c", "--compression", help="compression", choices=COMPRESSORS.keys())
+    parser.add_argument("--threads", help="compression threads (0: all cores)", type=int)
+    parser.add_argument(
+        "--proxy", help="bundle only the download cache, installed as a file:// GOPROXY", action="store_true"
+    )
     parser.add_argument("-f", "--conf", help="configuration file", type=Path)
     parser.add_argument("-l", "--latest", help="force latest", action="store_true")
     parser.add_argument("--vscode", help="vscode extension tools", action="store_true")
     parser.add_argument("-B", "--binary", help="binaries", action="append")
     parser.add_argument("-M", "--module", help="modules", action="append")
+    parser.add_argument("-S", "--source", help="source tree, to take the modules of its go.mod", action="append")
+    parser.add_argument("-j", "--jobs", help="parallel jobs", type=int)
+    parser.add_argument("--cache", help="persistent GOMODCACHE/GOCACHE dir", type=Path)
+    parser.add_argument("--cache-size", help="max cache size (e.g. 20G)")
+    parser.add_argument("--base", help="previous archive or gomods.txt, to make a delta archive", type=Path)
+    parser.add_argument("--indexed", help="compress by module and add an index", action="store_true")
+    parser.add_argument("--prune", help="archive only the modules of the build list", action="store_true")
+    parser.add_argument("-G", "--go-version", help="Go toolchains for the binaries (e.g. go1.22.5)", action="append")
+    parser.add_argument("-P", "--platform", help="platform of the binaries (e.g. linux/arm/v7)", action="append")
+    parser.add_argument("--split", help="one archive for the binaries of each platform", action="store_true")
+    parser.add_argument(
+        "--resume", help="record the completed stages, and skip those of an interrupted run", action="store_true"
+    )
+    parser.add_argument("--cprofile", help="dump the Python profile next to the archive", action="store_true")
 
     args = parser.parse_args()
 
@@ -418,26 +1617,109 @@ def main():
     elif args.conf:
         go_bins = section(args.conf, "gobin", args.latest)
         go_mods = section(args.conf, "go", args.latest)
-    elif args.module or args.binary:
+    elif args.module or args.binary or args.source:
         go_bins = args.binary or []
         go_mods = args.module or []
     else:
         go_bins = ["google.golang.org/protobuf/cmd/protoc-gen-go@latest"]
         go_mods = ["golang.org/x/tools@latest"]
 
-    a = GogoGadget(args.name, go_bins, go_mods, args.output, args.tag, args.compression)
+    # the platforms of the configuration apply to all binaries, the VS Code tools too
+    if args.conf and not args.platform:
+        args.platform = section(args.conf, "platforms", raw=True)
+
+    for platform in args.platform or []:
+        try:
+            platform_env(platform)
+        except ValueError as e:
+            logging.error(e)
+            exit(2)
+
+    if args.source:
+        # the exact versions used by the source trees
+        go_mods = sorted(set(go_mods) | set(scan_sources(args.source)))
+
+    cache = GoCache(args.cache, args.cache_size) if args.cache else None
+    profile = Profile()
+
+    a = GogoGadget(
+        args.name,
+        go_bins,
+        go_mods,
+        args.output,
+        args.tag,
+        args.compression,
+        args.jobs,
+        cache,
+        args.base,
+        args.threads,
+        args.proxy,
+        args.indexed,
+        args.prune,
+        args.go_version,
+        args.platform,
+        args.split,
+        profile,
+    )
 
     logging.debug(f"GOVERSION {a.GOVERSION}")
     logging.debug(f"GOFFLINE_VERSION {a.GOFFLINE_VERSION}")
 
-    a.download_bins()
-    a.download_mods()
-
-    a.info_file()
-    a.write_tools()
-    a.make_tar()
-
-    a.make_selfextract()
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler:
+        profiler.enable()
+
+    a.load_checkpoint(args.resume)
+
+    with profile.stage("download_bins"):
+        if not a.restore("download_bins"):
+            a.download_bins()
+            a.checkpoint("download_bins")
+    with profile.stage("download_mods"):
+        if not a.restore("download_mods"):
+            a.download_mods()
+            a.checkpoint("download_mods")
+
+    with profile.stage("info_file"):
+        a.info_file()
+    with profile.stage("write_tools"):
+        a.write_tools()
+
+    if a.mods or not a.split:
+        with profile.stage("make_selfextract"):
+            a.make_selfextract()
+    if a.split:
+        for platform in a.platforms:
+            with profile.stage(f"make_selfextract {platform}"):
+                a.make_selfextract(platform)
+
+    a.complete()
+
+    if cache:
+        with profile.stage("cache"):
+            cache.report()
+            cache.evict()
+
+    # timings report next to the archive
+    report = Path(a.output) / f"{a.name}-{a.label}-{a.tag}.profile"
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(f"{report}.pstats")
+    profile.write(
+        f"{report}.json",
+        tag=a.tag,
+        date=a.now_iso8601,
+        goffline=a.GOFFLINE_VERSION,
+        go=a.label,
+        compression=a.compression,
+        jobs=a.jobs,
+        platforms=a.platforms,
+    )
+    logging.info(f"Profile written to {report}.json")
+
+    if a.bins_failures:
+        logging.error(f"{len(a.bins_failures)} install(s) failed, the archive lacks: {', '.join(a.bins_failures)}")
+        exit(2)
 
 
 if __name__ == "__main__":
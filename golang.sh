@@ -14,6 +14,10 @@ dest_dir=$PWD/download
 config=${1:-config.txt}
 go_tag=
 show_version=
+bench=
+cache_dir=
+cache_size=
+sources=()
 
 while [[ ${1-} ]]; do
     case $1 in
@@ -21,7 +25,11 @@ while [[ ${1-} ]]; do
         -c|--config) config=$2 ; shift ;;
         --go-version) golang_version=$2 ; shift ;;
         --go-tag) go_tag=$2 ; shift ;;
+        --cache) mkdir -p $2; cache_dir=$(cd $2; pwd) ; shift ;;
+        --cache-size) cache_size=$2 ; shift ;;
+        --source) sources+=("$(cd $2; pwd)") ; shift ;;
         version) show_version=1 ;;
+        bench) bench=1 ;;
         --) shift; break ;;
         *) echo "Unknown option $1" ; exit 2 ;;
     esac
@@ -33,11 +41,30 @@ DOCKER_SCAN_SUGGEST=false \
 
 if [[ $show_version ]]; then
     exec docker run --rm goffline go env GOVERSION
+elif [[ $bench ]]; then
+    echo -e "\n\033[1;34m⏱️ Benchmark Go modules download (offline)\033[0m"
+    mkdir -p "$dest_dir"
+    exec docker run --init --rm -i --network none \
+        -v $dest_dir:/dl \
+        -w /dl \
+        goffline /bench-goget.py -o /dl/bench-goget.json "$@"
 else
     echo -e "\n\033[1;34m🍻 Download Go modules\033[0m"
     mkdir -p "$dest_dir"
+    cache_opts=()
+    if [[ $cache_dir ]]; then
+        cache_opts=(-v $cache_dir:/cache)
+        set -- --cache /cache ${cache_size:+--cache-size $cache_size} "$@"
+    fi
+    source_opts=()
+    for i in ${sources[@]+"${!sources[@]}"}; do
+        source_opts+=(-v "${sources[$i]}:/src/$i:ro")
+        set -- --source /src/$i "$@"
+    done
     exec docker run --init -e TINI_KILL_PROCESS_GROUP=1 --rm -i \
         -v $dest_dir:/dl \
+        ${cache_opts[@]+"${cache_opts[@]}"} \
+        ${source_opts[@]+"${source_opts[@]}"} \
         -v $(realpath "$config"):/config.txt:ro \
         -e GOFFLINE_VERSION=$goffline_version \
         -w /dl \
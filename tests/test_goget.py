@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import goget  # noqa: E402
+
+
+class Stop(Exception):
+    pass
+
+
+def test_vscode_platforms_from_config(tmp_path, monkeypatch):
+    conf = tmp_path / "config.txt"
+    conf.write_text("[gobin]\nexample.com/cmd/tool\n\n[platforms]\nlinux/amd64\nlinux/arm/v7\n")
+
+    gadget_args = []
+
+    def gadget(*args):
+        gadget_args.extend(args)
+        raise Stop
+
+    monkeypatch.setenv("GOPATH", "/go")
+    monkeypatch.setattr(goget, "vscode_ext_tools", lambda: ["golang.org/x/tools/gopls@v0.16.0"])
+    monkeypatch.setattr(goget, "GogoGadget", gadget)
+    monkeypatch.setattr(sys, "argv", ["goget.py", "-f", str(conf), "--vscode"])
+
+    with pytest.raises(Stop):
+        goget.main()
+
+    # positional arguments of GogoGadget: name, bins, ..., platforms
+    assert gadget_args[1] == ["golang.org/x/tools/gopls@v0.16.0"]
+    assert gadget_args[14] == ["linux/amd64", "linux/arm/v7"]
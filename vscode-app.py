@@ -2,11 +2,10 @@
 # Download Visual Studio Code client and server, and a list of extensions
 
 import argparse
-import os
 import requests
 from pathlib import Path
 import re
-from dateutil.parser import parse as parsedate
+from downloader import download as download_file, DownloadError
 
 
 def download(dest_dir: Path, urls, version):
@@ -26,17 +25,12 @@ def download(dest_dir: Path, urls, version):
         if not file.exists():
             file.parent.mkdir(parents=True, exist_ok=True)
             print(f"downloading {file}")
-            r = session.get(real_url)
-            file.write_bytes(r.content)
-
-            if int(r.headers["Content-Length"]) != file.stat().st_size:
-                file.unlink()
-                print(f"download problem {url}")
+            try:
+                # streamed, checked against Content-Length and dated with Last-Modified
+                download_file(session, real_url, file)
+            except DownloadError as e:
+                print(f"download problem {url}: {e}")
                 exit(2)
-
-            url_date = parsedate(r.headers["Last-Modified"])
-            mtime = round(url_date.timestamp() * 1_000_000_000)
-            os.utime(file, ns=(mtime, mtime))
         else:
             print(f"already downloaded: {name}")
 
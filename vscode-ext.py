@@ -5,11 +5,13 @@ import argparse
 import json
 import requests
 from pathlib import Path
-import os
-from dateutil.parser import parse as parsedate
 import re
-import zipfile
 import subprocess
+import concurrent.futures
+import functools
+import hashlib
+import time
+from downloader import download, DownloadError
 
 
 # constants from vscode extension API
@@ -38,17 +40,29 @@ Flags_IncludeLatestVersionOnly = 0x200
 Flags_Unpublished = 0x1000
 Flags_IncludeNameConflictInfo = 0x8000
 
-
-def get_property(version, name):
-    if "properties" not in version:
-        # print(version)
-        return
-    for property in version["properties"]:
-        if property["key"] == name:
-            return property["value"]
-    return
-
-
+# target platforms of the extensions
+# https://code.visualstudio.com/api/working-with-extensions/publishing-extension#platformspecific-extensions
+TargetPlatforms = [
+    "linux-x64",
+    "linux-arm64",
+    "linux-armhf",
+    "alpine-x64",
+    "alpine-arm64",
+    "win32-x64",
+    "win32-ia32",
+    "win32-arm64",
+    "darwin-x64",
+    "darwin-arm64",
+    "web",
+]
+
+# downloaded if not configured
+DefaultPlatforms = TargetPlatforms[:8]
+
+ExtensionQueryUrl = "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery"
+
+
+@functools.lru_cache(maxsize=None)
 def version_serial(version):
     v = version.split(".", maxsplit=2)
     if "-" in v[2]:
@@ -62,6 +76,7 @@ def version_serial(version):
         return tuple(map(int, v))
 
 
+@functools.lru_cache(maxsize=None)
 def engine_match(pattern, engine):
     if pattern == "*":
         return True
@@ -95,73 +110,274 @@ def engine_match(pattern, engine):
     return r
 
 
+def iter_extensions(response_file, chunk_size=1024 * 1024):
+    """Yield the extensions of an extensionquery response one by one, without loading the whole JSON."""
+    decoder = json.JSONDecoder()
+    with open(response_file, encoding="utf-8") as f:
+        buffer = ""
+        pos = -1
+        # find the extensions array (of the first result)
+        while pos < 0:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            buffer += data
+            start = buffer.find('"extensions"')
+            if start >= 0:
+                pos = buffer.find("[", start)
+        pos += 1
+
+        eof = False
+        while True:
+            # skip separators, to the next value or the end of the array
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos == len(buffer):
+                    raise json.JSONDecodeError("more data needed", buffer, pos)
+                extension, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # incomplete value: read more (at least as much as the buffer, not to decode it too often)
+                buffer = buffer[pos:]
+                pos = 0
+                data = f.read(max(chunk_size, len(buffer)))
+                eof = not data
+                buffer += data
+                continue
+            yield extension
+            buffer = buffer[pos:]
+            pos = 0
+
+
+class VersionIndex:
+    """The usable builds of an extension, parsed once.
+    A version number has a build per target platform, or a build for all (None), or both."""
+
+    def __init__(self, extension, engine):
+        builds = []
+        self.targeted = {}
+        for position, version in enumerate(extension["versions"]):
+            # sanity check
+            if version["flags"] != "validated" and version["flags"] != "none":
+                print("flags should be 'validated' or 'none'")
+                print(json.dumps(version, indent=2))
+                exit()
+
+            properties = {i["key"]: i["value"] for i in version.get("properties", [])}
+
+            # do not use pre-release version
+            if properties.get("Microsoft.VisualStudio.Code.PreRelease") == "true":
+                continue
+
+            # we have to match the engine version
+            pattern = properties.get("Microsoft.VisualStudio.Code.Engine")
+            if not (pattern and engine_match(pattern, engine)):
+                continue
+
+            target = version.get("targetPlatform")
+            if target is not None:
+                # first position of a build for a platform, for each version number
+                self.targeted.setdefault(version["version"], position)
+            builds.append((version_serial(version["version"]), position, target, version, properties))
+
+        # newest first, and the last listed first for a same version
+        self.builds = sorted(builds, key=lambda i: i[:2], reverse=True)
+        self.by_platform = {}
+
+    def latest(self, platform):
+        """Return the newest (version, properties) for a platform: its own build, or the build for all
+        unless a build for a platform of the same version is listed before it."""
+        if platform not in self.by_platform:
+
+            def usable(position, target, version):
+                if target is None:
+                    return self.targeted.get(version["version"], position) >= position
+                return target == platform
+
+            self.by_platform[platform] = next(
+                (
+                    (version, properties)
+                    for _, position, target, version, properties in self.builds
+                    if usable(position, target, version)
+                ),
+                (None, None),
+            )
+        return self.by_platform[platform]
+
+
 class Extension:
-    def __init__(self, engine, verbose=False):
+    def __init__(
+        self,
+        engine,
+        verbose=False,
+        jobs=8,
+        timeout=60,
+        retries=4,
+        platforms=None,
+        cache_dir=Path(".extensionquery"),
+        cache_ttl=3600,
+        page_size=20,
+    ):
         self.engine = engine
         self.verbose = verbose
+        self.platforms = platforms or DefaultPlatforms
+        self.jobs = jobs
+        self.timeout = timeout
+        self.retries = retries
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.page_size = page_size
+
+        # connections are kept alive and shared by the download threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def run(self, dest_dir, slugs):
-        """Download all extensions and packs."""
+        """Resolve all extensions with their packs and dependencies, then download them."""
 
         self.all_extensions = set()
+        self.downloads = {}
+        self.manifests = {}
+        self.fetched = set()
+        queried = set()
+
+        # one marketplace query per level of the graph
+        level = set(slugs)
+        while level:
+            queried.update(map(str.lower, level))
+            self._get_downloads(level)
+            level = set(i for i in self._get_dependencies() if i.lower() not in queried)
+            if level:
+                print(f"adding packs and dependencies: {' '.join(sorted(level))}")
 
-        self._get_downloads(slugs)
         self._download_files(dest_dir)
 
-        while self.packs:
-            new_extensions = set()
-
-            for vsix in self.downloads:
-                if vsix in self.packs:
-                    zip = zipfile.ZipFile(dest_dir / vsix)
-                    m = json.loads(zip.open("extension/package.json").read())
-                    new_extensions.update(m["extensionPack"])
-                    zip.close()
+    def _get_dependencies(self):
+        """Read the extension packs and dependencies from the manifest (package.json) of the selected versions."""
+
+        urls = set()
+        for versions in self.manifests.values():
+            urls.update(versions.values())
+        urls.difference_update(self.fetched)
+        self.fetched.update(urls)
+
+        def fetch(url):
+            r = self.session.get(url, timeout=(10, self.timeout))
+            r.raise_for_status()
+            return r.json()
+
+        slugs, failures = set(), []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(fetch, url): url for url in sorted(urls)}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    manifest = future.result()
+                except (requests.RequestException, ValueError) as e:
+                    print(f"cannot read manifest {futures[future]}: {e}")
+                    failures.append(futures[future])
+                    continue
+                slugs.update(manifest.get("extensionPack") or [])
+                slugs.update(manifest.get("extensionDependencies") or [])
 
-            new_extensions.difference_update(self.all_extensions)
+        # the packs and dependencies of these extensions would be missing
+        if failures:
+            print(f"{len(failures)} manifest(s) cannot be read")
+            exit(2)
 
-            self._get_downloads(new_extensions)
-            self._download_files(dest_dir)
+        # built-in extensions are not in the marketplace
+        return set(i for i in slugs if not i.lower().startswith("vscode."))
 
     def _download_files(self, dest_dir):
-        """Download extesions archive (VSIX)."""
+        """Download extensions archives (VSIX), in parallel."""
+        todo = []
         for k, v in self.downloads.items():
             vsix = dest_dir / k
             if not vsix.exists():
                 vsix.parent.mkdir(parents=True, exist_ok=True)
-                print("downloading", vsix)
-                r = requests.get(v[2])
-                vsix.write_bytes(r.content)
-
-                url_date = parsedate(v[3])
-                mtime = round(url_date.timestamp() * 1_000_000_000)
-                os.utime(vsix, ns=(mtime, mtime))
+                todo.append((vsix, v[2], v[3]))
             else:
                 print(f"already downloaded: {vsix.name}")
 
+        if not todo:
+            return
+
+        done, size, failures = 0, 0, []
+        t0 = time.monotonic()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {}
+            for vsix, url, last_updated in todo:
+                # the file date is the lastUpdated of the version
+                future = executor.submit(
+                    download, self.session, url, vsix, last_updated, timeout=self.timeout, retries=self.retries
+                )
+                futures[future] = vsix
+            for future in concurrent.futures.as_completed(futures):
+                vsix = futures[future]
+                try:
+                    n = future.result()
+                except DownloadError as e:
+                    print(f"download problem: {e}")
+                    failures.append(vsix)
+                    continue
+                done += 1
+                size += n
+                elapsed = time.monotonic() - t0
+                print(f"[{done}/{len(todo)}] downloaded {vsix.name} ({size / elapsed / 1e6:.1f} MB/s)")
+
+        elapsed = time.monotonic() - t0
+        print(f"{done} files, {size / 1e6:.1f} MB in {elapsed:.1f}s ({size / elapsed / 1e6:.1f} MB/s)")
+
+        if failures:
+            exit(2)
+
     def _get_downloads(self, slugs):
-        """Build the extension list to download."""
-        self.downloads = {}
-        self.packs = set()
+        """Add extensions to the list to download."""
         if not slugs:
             return
-        r = self._query(slugs)
-        for result in r["results"]:
-            for extension in result["extensions"]:
-                vsix = self._get_download(extension)
-                if vsix:
-                    if "Extension Packs" in extension["categories"]:
-                        self.packs.update(vsix)
+        found = set()
+        for extension in self._query(slugs):
+            found.add((extension["publisher"]["publisherName"] + "." + extension["extensionName"]).lower())
+            vsix = self._get_download(extension)
+            if vsix:
+                self.all_extensions.update(vsix)
 
-                    self.all_extensions.update(vsix)
+        for slug in sorted(slugs):
+            if slug.lower() not in found:
+                print(f"extension not found: {slug}")
 
     def _query(self, slugs):
+        """Query the extension server by pages of slugs, in parallel. Yield the extensions."""
+        slugs = sorted(set(slugs), key=str.lower)
+        pages = [slugs[i : i + self.page_size] for i in range(0, len(slugs), self.page_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            responses = list(executor.map(self._query_page, pages))
+        for response in responses:
+            yield from iter_extensions(response)
+
+    def _query_page(self, slugs):
         """
         Prepare the request tp the extension server, with::
            - assets uri (Flags.IncludeAssetUri)
            - details (Flags.IncludeVersionProperties)
            - categories (Flags.IncludeCategoryAndTags)
+        The response is kept in the cache dir for cache_ttl seconds, then revalidated. Return the response file.
         """
+        flags = Flags_IncludeAssetUri + Flags_IncludeVersionProperties + Flags_IncludeCategoryAndTags
+
+        key = hashlib.sha256(json.dumps([sorted(map(str.lower, slugs)), flags]).encode()).hexdigest()
+        response = self.cache_dir / f"{key}.json"
+        meta_file = self.cache_dir / f"{key}.meta"
+        meta = json.loads(meta_file.read_text()) if response.is_file() and meta_file.is_file() else None
+        if meta and time.time() - meta["time"] < self.cache_ttl:
+            return response
+
         data = {
             "filters": [
                 {
@@ -181,77 +397,78 @@ class Extension:
                     ]
                 }
             ],
-            "flags": Flags_IncludeAssetUri + Flags_IncludeVersionProperties + Flags_IncludeCategoryAndTags,
+            "flags": flags,
         }
 
         for slug in slugs:
             data["filters"][0]["criteria"].append({"filterType": FilterType_ExtensionName, "value": slug})
 
+        # all the extensions of the page in one response
+        data["filters"][0]["pageNumber"] = 1
+        data["filters"][0]["pageSize"] = len(slugs)
+
         data = json.dumps(data)
 
-        r = requests.post(
-            "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
-            data=data,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json;api-version=3.0-preview.1",
-            },
-        )
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json;api-version=3.0-preview.1",
+        }
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
         if self.verbose:
-            Path("query.json").write_text(data)
-            Path("response.json").write_bytes(r.content)
-        r = r.json()
-        # r = json.load(open("response.json"))
-        return r
+            print(f"query {' '.join(slugs)} -> {response}")
+
+        try:
+            with self.session.post(
+                ExtensionQueryUrl, data=data, headers=headers, stream=True, timeout=(10, self.timeout)
+            ) as r:
+                if r.status_code == 304:
+                    # not modified
+                    meta["time"] = time.time()
+                    meta_file.write_text(json.dumps(meta))
+                    return response
+                r.raise_for_status()
+
+                # streamed to the cache, and parsed from it
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                part = response.with_suffix(".part")
+                with part.open("wb") as f:
+                    for chunk in r.iter_content(1024 * 1024):
+                        f.write(chunk)
+                part.replace(response)
+
+                meta = {
+                    "time": time.time(),
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "slugs": slugs,
+                }
+                meta_file.write_text(json.dumps(meta))
+        except requests.RequestException as e:
+            print(f"extension query error: {e}")
+            exit(2)
+
+        return response
 
     def _get_download(self, extension):
         name = extension["publisher"]["publisherName"] + "." + extension["extensionName"]
 
-        def filter_version(extension, platform):
-            has_target_platform = set()
-
-            for version in extension["versions"]:
-                # sanity check
-                if version["flags"] != "validated" and version["flags"] != "none":
-                    print("flags should be 'validated' or 'none'")
-                    print(json.dumps(version, indent=2))
-                    exit()
-
-                # do not use pre-release version
-                v = get_property(version, "Microsoft.VisualStudio.Code.PreRelease")
-                if v == "true":
-                    continue
-
-                # we have to match the engine version
-                v = get_property(version, "Microsoft.VisualStudio.Code.Engine")
-                if not (v and engine_match(v, self.engine)):
-                    continue
-
-                if version.get("targetPlatform") != None:
-                    has_target_platform.add(version["version"])
-
-                # we have to match the platform if asked and specified for the version
-                if version["version"] in has_target_platform and platform and version.get("targetPlatform") != platform:
-                    continue
-
-                yield version
-
-        def find_latest_version(extension, platform):
-            versions = filter_version(extension, platform)
-            versions = sorted(versions, key=lambda v: version_serial(v["version"]))
-            if versions:
-                return versions[-1]
+        index = VersionIndex(extension, self.engine)
 
         def find_version_vsix(extension, platform):
-            version = find_latest_version(extension, platform)
+            version, properties = index.latest(platform)
 
             if name == "vadimcn.vscode-lldb":
-                if "alpine" in platform:
-                    return
-
-                os, arch = platform.split("-")
+                os, _, arch = platform.partition("-")
                 # cf. extension/package.json of the generic extension
                 arch = {"x64": "x86_64", "arm64": "aarch64"}.get(arch)
+                if os not in ("linux", "darwin", "win32") or not arch or not version:
+                    # no codelldb build for alpine, web, or the other architectures
+                    return
+
                 asset_uri = f"https://github.com/vadimcn/vscode-lldb/releases/download/v{version['version']}/codelldb-{arch}-{os}.vsix"
                 target_platform = platform
 
@@ -269,7 +486,7 @@ class Extension:
 
             download = (
                 version["version"],
-                get_property(version, "Microsoft.VisualStudio.Code.Engine"),
+                properties["Microsoft.VisualStudio.Code.Engine"],
                 asset_uri,
                 version["lastUpdated"],
             )
@@ -278,17 +495,15 @@ class Extension:
                 assert self.downloads[vsix] == download
 
             self.downloads[vsix] = download
+
+            # the package.json, for the packs and dependencies
+            manifest_uri = version["assetUri"] + "/Microsoft.VisualStudio.Code.Manifest"
+            self.manifests.setdefault(name, {}).setdefault(version["version"], manifest_uri)
             return vsix
 
         vsix = set()
-        vsix.add(find_version_vsix(extension, "linux-x64"))
-        vsix.add(find_version_vsix(extension, "linux-arm64"))
-        vsix.add(find_version_vsix(extension, "linux-armhf"))
-        vsix.add(find_version_vsix(extension, "alpine-x64"))
-        vsix.add(find_version_vsix(extension, "alpine-arm64"))
-        vsix.add(find_version_vsix(extension, "win32-x64"))
-        vsix.add(find_version_vsix(extension, "win32-ia32"))
-        vsix.add(find_version_vsix(extension, "win32-arm64"))
+        for platform in self.platforms:
+            vsix.add(find_version_vsix(extension, platform))
         return vsix
 
 
@@ -363,6 +578,11 @@ def main():
     parser.add_argument("-d", "--dest-dir", help="output dir", type=Path, default=".")
     parser.add_argument("-e", "--engine", help="engine version", default="current")
     parser.add_argument("-c", "--config", help="conf file", type=Path)
+    parser.add_argument("-j", "--jobs", help="parallel downloads", type=int, default=8)
+    parser.add_argument("--timeout", help="download timeout (seconds)", type=int, default=60)
+    parser.add_argument("-p", "--platform", help="target platform (e.g. linux-x64)", action="append")
+    parser.add_argument("--cache-ttl", help="marketplace query cache duration (seconds)", type=int, default=3600)
+    parser.add_argument("--page-size", help="extensions per marketplace query", type=int, default=20)
     parser.add_argument("--local", help="from local VS Code", action="store_true")
     parser.add_argument("--check-local", help=argparse.SUPPRESS, action="store_true")
     parser.add_argument("slugs", help="extension identifier", nargs="*")
@@ -378,17 +598,26 @@ def main():
             if f.is_file():
                 args.slugs.extend(f.read_text().splitlines())
 
+    platforms = []
     if args.config:
-        in_section = False
+        in_section = None
         for i in args.config.read_text().splitlines():
             i = i.strip()
             if not i or i.startswith("#"):
                 continue
             if i.startswith("["):
-                in_section = i.startswith("[vscode")
-            else:
-                if in_section:
-                    args.slugs.append(i)
+                in_section = "slugs" if i.startswith("[vscode") else "platforms" if i == "[vsix-platforms]" else None
+            elif in_section == "slugs":
+                args.slugs.append(i)
+            elif in_section == "platforms":
+                platforms.append(i)
+
+    # the command line wins over the configuration file
+    platforms = args.platform or platforms
+    for platform in platforms:
+        if platform not in TargetPlatforms:
+            print(f"unknown platform {platform}, should be one of: {' '.join(TargetPlatforms)}")
+            exit(2)
 
     if args.check_local:
         exit(check_local(args.slugs))
@@ -402,7 +631,16 @@ def main():
     dest_dir = args.dest_dir / f"vscode-extensions-{args.engine}"
     dest_dir.mkdir(exist_ok=True, parents=True)
 
-    e = Extension(args.engine, args.verbose)
+    e = Extension(
+        args.engine,
+        args.verbose,
+        args.jobs,
+        args.timeout,
+        platforms=platforms,
+        cache_dir=args.dest_dir / ".extensionquery",
+        cache_ttl=args.cache_ttl,
+        page_size=args.page_size,
+    )
     e.run(dest_dir, args.slugs)
 
 